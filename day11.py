@@ -1,155 +1,12 @@
 #!/usr/bin/env python
 
-from collections import defaultdict
 import fileinput
 
+import numpy as np
 
-ADD = 1
-MULTIPLY = 2
-INPUT = 3
-OUTPUT = 4
-JUMP_IF_TRUE = 5
-JUMP_IF_FALSE = 6
-LESS_THAN = 7
-EQUALS = 8
-ADJUST_RELATIVE_BASE = 9
-STOP = 99
-
-
-NUM_PARAMS = {
-    ADD: 3,
-    MULTIPLY: 3,
-    INPUT: 1,
-    OUTPUT: 1,
-    JUMP_IF_TRUE: 2,
-    JUMP_IF_FALSE: 2,
-    LESS_THAN: 3,
-    EQUALS: 3,
-    ADJUST_RELATIVE_BASE: 1,
-    STOP: 0
-}
-
-MODE_POS = 0
-MODE_IMM = 1
-MODE_REL = 2
-
-
-def decode_instruction(instruction):
-    opcode = instruction % 100
-    num_params = NUM_PARAMS[opcode]
-    modes = [MODE_POS] * num_params
-    instruction //= 100
-    i = 0
-    while instruction:
-        modes[i] = instruction % 10
-        instruction //= 10
-        i += 1
-    return opcode, modes
-
-
-class IntCode:
-    def __init__(self, memory, inputs=None):
-        self.memory = defaultdict(int)
-        self.memory.update(enumerate(memory))
-        self.instruction_ptr = 0
-        self.inputs = inputs or []
-        self.outputs = []
-        self.is_halted = False
-        self.relative_base = 0
-
-    def pop_input(self):
-        v, *rest = self.inputs
-        self.inputs = rest
-        return v
-
-    def output(self, value):
-        self.outputs.append(value)
-
-    def decode_param(self, v, mode):
-        if mode == MODE_IMM:
-            return v
-        elif mode == MODE_POS:
-            return self.memory[v]
-        elif mode == MODE_REL:
-            return self.memory[self.relative_base + v]
-        raise ValueError(f'Invalid mode {mode}')
-
-    def write_memory(self, parameter, mode, value):
-        if mode == MODE_POS:
-            self.memory[parameter] = value
-        elif mode == MODE_REL:
-            self.memory[self.relative_base + parameter] = value
-        else:
-            raise ValueError(f'Invalid mode for write: {mode}')
-
-    def run_one_instruction(self):
-        m = self.memory
-        instruction = m[self.instruction_ptr]
-        opcode, modes = decode_instruction(instruction)
-
-        if opcode == STOP:
-            self.is_halted = True
-            return
-
-        num_params = len(modes)
-        parameters = [
-            m[self.instruction_ptr + i]
-            for i in range(1, 1 + num_params)
-        ]
-
-        vals = [
-            self.decode_param(v, mode)
-            for v, mode in zip(parameters, modes)
-        ]
-
-        self.instruction_ptr += 1 + len(parameters)
-
-        if opcode == ADD:
-            self.write_memory(parameters[2], modes[2], vals[0] + vals[1])
-        elif opcode == MULTIPLY:
-            self.write_memory(parameters[2], modes[2], vals[0] * vals[1])
-        elif opcode == INPUT:
-            val = self.pop_input()
-            self.write_memory(parameters[0], modes[0], val)
-        elif opcode == OUTPUT:
-            self.output(vals[0])
-        elif opcode == JUMP_IF_TRUE:
-            if vals[0] != 0:
-                self.instruction_ptr = vals[1]
-        elif opcode == JUMP_IF_FALSE:
-            if vals[0] == 0:
-                self.instruction_ptr = vals[1]
-        elif opcode == LESS_THAN:
-            self.write_memory(
-                parameters[2], modes[2],
-                1 if vals[0] < vals[1] else 0
-            )
-        elif opcode == EQUALS:
-            self.write_memory(
-                parameters[2], modes[2],
-                1 if vals[0] == vals[1] else 0
-            )
-        elif opcode == ADJUST_RELATIVE_BASE:
-            self.relative_base += vals[0]
-        else:
-            raise ValueError(f'Invalid opcode: {opcode}')
-
-    def run(self):
-        """Run to halt. Returns outputs."""
-        while not self.is_halted:
-            self.run_one_instruction()
-
-        return self.outputs
-
-    def run_to_output(self):
-        """Run until the program outputs.
-
-        Returns that output or None if the program halts before output."""
-        self.outputs = []
-        while not self.is_halted and not self.outputs:
-            self.run_one_instruction()
-
-        return self.outputs[0] if self.outputs else None
+from intcode import (
+    ENGINE_AOT, ENGINE_CACHED, HALTED, HAS_OUTPUT, IntCode, read_memory
+)
 
 
 DIR_UP = 0
@@ -166,6 +23,8 @@ DXDY = {
 
 
 class HullPaintingRobot(IntCode):
+    engine = ENGINE_CACHED
+
     def __init__(self, memory):
         super().__init__(memory)
         self.x = 0
@@ -193,9 +52,117 @@ class HullPaintingRobot(IntCode):
         self.is_painting = not self.is_painting
 
 
-def read_memory(inp):
-    text = ''.join(line for line in inp)
-    return [int(x) for x in text.split(',')]
+class Canvas:
+    """A grid of colors which grows to fit whatever is painted on it.
+
+    Cells are addressed by (x, y), which can be negative; origin is where
+    (0, 0) is in the arrays. painted records every cell ever painted.
+    """
+
+    def __init__(self, size=16):
+        self.colors = np.zeros((size, size), dtype=np.uint8)
+        self.painted = np.zeros((size, size), dtype=bool)
+        self.origin = (size // 2, size // 2)  # (x, y)
+
+    def _grow(self, x, y):
+        """Double the arrays in each direction that (x, y) is off."""
+        height, width = self.colors.shape
+        ox, oy = self.origin
+        left = width if x + ox < 0 else 0
+        right = width if x + ox >= width else 0
+        top = height if y + oy < 0 else 0
+        bottom = height if y + oy >= height else 0
+        pad = ((top, bottom), (left, right))
+        self.colors = np.pad(self.colors, pad)
+        self.painted = np.pad(self.painted, pad)
+        self.origin = (ox + left, oy + top)
+
+    def _index(self, x, y):
+        ox, oy = self.origin
+        height, width = self.colors.shape
+        while not (0 <= x + ox < width and 0 <= y + oy < height):
+            self._grow(x, y)
+            ox, oy = self.origin
+            height, width = self.colors.shape
+        return y + oy, x + ox
+
+    def __getitem__(self, xy):
+        x, y = xy
+        ox, oy = self.origin
+        height, width = self.colors.shape
+        if 0 <= x + ox < width and 0 <= y + oy < height:
+            return int(self.colors[y + oy, x + ox])
+        return 0
+
+    def __setitem__(self, xy, color):
+        i = self._index(*xy)
+        self.colors[i] = color
+        self.painted[i] = True
+
+    def __len__(self):
+        """The number of cells which have been painted."""
+        return int(np.count_nonzero(self.painted))
+
+    def render(self):
+        """The painted area as rows of '#' (non-zero) and '.'."""
+        rows = np.flatnonzero(self.painted.any(axis=1))
+        cols = np.flatnonzero(self.painted.any(axis=0))
+        if not len(rows):
+            return ''
+        box = self.colors[rows[0]:rows[-1] + 1, cols[0]:cols[-1] + 1]
+        chars = np.where(box != 0, ord('#'), ord('.')).astype(np.uint8)
+        return ''.join(row.tobytes().decode() + '\n' for row in chars)
+
+
+class TurboRobot(IntCode):
+    """HullPaintingRobot painting onto a Canvas.
+
+    Rather than handling each output as it happens, paint() runs the
+    program until it wants the color under the robot, then applies all
+    the (color, turn) pairs output since in one go. The program patches
+    its own operands, which the AOT engine handles without recompiling.
+    """
+
+    engine = ENGINE_AOT
+
+    def __init__(self, memory, start_color=1):
+        super().__init__(memory)
+        self.x = 0
+        self.y = 0
+        self.dir = DIR_UP
+        self.canvas = Canvas()
+        self.canvas[0, 0] = start_color
+
+    def paint(self):
+        outputs = self.outputs
+        while True:
+            status = self.run_until_blocked()
+            if status == HAS_OUTPUT:
+                continue
+            if len(outputs) >= 2:
+                self.apply(outputs.drain())
+            if status == HALTED:
+                return self.canvas
+            self.inputs.push(self.canvas[self.x, self.y])
+
+    def apply(self, values):
+        """Paint and move for each (color, turn) pair in values."""
+        canvas = self.canvas
+        x, y, dir_ = self.x, self.y, self.dir
+        for color, turn in zip(values[::2], values[1::2]):
+            canvas[x, y] = color
+            if turn == 0:
+                dir_ = (3 + dir_) % 4  # Turn left 90 degrees
+            elif turn == 1:
+                dir_ = (1 + dir_) % 4  # Turn right 90 degrees
+            else:
+                raise ValueError(f'Invalid turn {turn}')
+            dx, dy = DXDY[dir_]
+            x += dx
+            y += dy
+        self.x, self.y, self.dir = x, y, dir_
+        if len(values) % 2:
+            self.outputs.push(values[-1])  # The rest of a pair to come
 
 
 def print_hull(colors):
@@ -218,7 +185,6 @@ if __name__ == '__main__':
     inp = open('inputs/day11.txt')
     memory = read_memory(inp)
     # memory = [104, 1125899906842624, 99]
-    program = HullPaintingRobot(memory)
-    program.run()
-    print_hull(program.colors)
-    print(len(program.colors))
+    canvas = TurboRobot(memory).paint()
+    print(canvas.render(), end='')
+    print(len(canvas))
@@ -2,7 +2,6 @@
 
 import curses
 import fileinput
-import json
 import os
 import time
 import sys
@@ -37,6 +36,7 @@ class ArcadeCabinet(IntCode):
         self.ball = None
         self.last_hit = None
         self.screen_contents = {}
+        self.saves = 0
         self.log = open(f'data/breakout.{int(time.time())}.log.txt', 'w')
 
     def pop_input(self):
@@ -112,19 +112,28 @@ class ArcadeCabinet(IntCode):
         return sum(1 for v in self.screen.values() if v == TILE_BLOCK)
 
     def save(self):
-        obj = {
-            'mem': self.memory,
+        extra = {
             'scr': [
                 (x, y, c) for (x, y), c in self.screen_contents.items()
             ],
             'x': self.x,
             'y': self.y,
-            'i': self.instruction_ptr,
         }
-        with open('data/breakout.json', 'w') as f:
-            json.dump(obj, f)
-        with open(f'data/breakout.{self.score}.json', 'w') as f:
-            json.dump(obj, f)
+        # Only the first save holds every page; each later one only holds
+        # what changed since the one before, so keep them all.
+        path = f'data/breakout.{self.score}.{self.saves}.ckpt'
+        self.checkpoint(path, incremental=self.saves > 0, extra=extra)
+        saved = self.last_checkpoint
+        # The rolling save just points at that one.
+        self.checkpoint('data/breakout.ckpt', incremental=True, extra=extra)
+        self.last_checkpoint = saved
+        self.saves += 1
+
+    def load(self, path='data/breakout.ckpt'):
+        obj = self.load_checkpoint(path)
+        self.screen_contents = {(x, y): c for (x, y, c) in obj['scr']}
+        self.x = obj['x']
+        self.y = obj['y']
 
 
 def address_for_block_intcode(x, y):
@@ -156,17 +165,13 @@ def address_for_block(x, y):
 if __name__ == '__main__':
     restore_from_saved = False
 
+    memory = []
     if not restore_from_saved:
         # inp = fileinput.input()
         inp = open('inputs/day13.txt')
         memory = read_memory(inp)
         memory[0] = 2  # play for free
     # memory = [104, 1125899906842624, 99]
-    else:
-        obj = json.load(open('data/breakout.json'))
-        memory = {}
-        for k, v in obj['mem'].items():
-            memory[int(k)] = v
 
     os.system('clear')
     screen = curses.initscr()
@@ -174,20 +179,14 @@ if __name__ == '__main__':
     curses.noecho()
     curses.cbreak()
     curses.curs_set(False)
-    if restore_from_saved:
-        for x, y, v in obj['scr']:
-            screen.addch(y, x, v)
-    screen.refresh()
 
     program = ArcadeCabinet(memory)
     program.screen = screen
     if restore_from_saved:
-        program.screen_contents = {
-            (x, y): c for (x, y, c) in obj['scr']
-        }
-        program.instruction_ptr = obj['i']
-        program.x = obj['x']
-        program.y = obj['y']
+        program.load()
+        for (x, y), c in program.screen_contents.items():
+            screen.addch(y, x, c)
+    screen.refresh()
 
     program.run()
 
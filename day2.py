@@ -1,7 +1,8 @@
 #!/usr/bin/env python
 
 import fileinput
-import sys
+
+from intcode import Linear, SymbolicIntCode
 
 
 ADD = 1
@@ -44,16 +45,29 @@ def replace_gravity_assist(memory, noun, verb):
 
 
 def find_inputs(init_memory, target_value):
-    for total in range(0, 200):
-        for verb in range(0, 1 + total):
-            noun = total - verb
-            memory = init_memory[:]
-            replace_gravity_assist(memory, noun, verb)
-            run_program(memory)
-            output = memory[0]
-            sys.stderr.write(f'{noun} {verb} -> {output}\n')
-            if output == target_value:
-                return (noun, verb)
+    """The (noun, verb) with the smallest total, then verb, for which the
+    program leaves target_value in memory[0].
+
+    memory[0] ends up as an affine function of the noun and verb, so this
+    runs the program once symbolically and solves for the verb."""
+    program = SymbolicIntCode(init_memory, symbols={1: 'noun', 2: 'verb'})
+    program.run()
+    output = program[0]
+    if not isinstance(output, Linear):
+        output = Linear(const=output)
+    per_verb = output.terms.get('verb', 0)
+    solutions = []
+    for noun in range(200):
+        rest = target_value - output.evaluate({'noun': noun, 'verb': 0})
+        if per_verb:
+            verb, remainder = divmod(rest, per_verb)
+            verbs = [] if remainder else [verb]
+        else:
+            verbs = range(200) if rest == 0 else []
+        solutions += [
+            (noun, verb) for verb in verbs if 0 <= verb < 200 - noun
+        ]
+    return min(solutions, key=lambda s: (sum(s), s[1]), default=None)
 
 
 if __name__ == '__main__':
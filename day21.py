@@ -1,8 +1,9 @@
 #!/usr/bin/env python
 
 import fileinput
+import time
 
-from intcode import read_program
+from intcode import ENGINE_AOT, HALTED, IntCode, read_memory
 
 
 '''
@@ -122,6 +123,10 @@ when you jump you land on D
 '''
 
 
+# A springscript which never finishes shouldn't hang us.
+TIMEOUT = 60
+
+
 springscript = '''
 # Jump three squares out
 # = B & D & not (C | (F & not E))
@@ -192,12 +197,14 @@ def should_jump_spring(sensors):
 
 if __name__ == '__main__':
     inp = fileinput.input()
-    program = read_program(inp)
+    program = IntCode(read_memory(inp), engine=ENGINE_AOT)
     springscript = '\n'.join(
         line
         for line in springscript.split('\n')
         if line and not line.startswith('#')
     ) + '\n'
     program.inputs = [ord(x) for x in springscript]
-    program.run()
+    program.run(deadline=time.monotonic() + TIMEOUT)
+    if program.run_status != HALTED:
+        raise SystemExit(f'Springdroid still running after {TIMEOUT}s')
     print(''.join(chr(x) if x < 255 else str(x) for x in program.outputs))
@@ -1,5 +1,6 @@
 #!/usr/bin/env python
 
+from collections import deque
 import fileinput
 import sys
 
@@ -7,6 +8,9 @@ import intcode
 
 
 class NIC(intcode.IntCode):
+    engine = intcode.ENGINE_COMPILED
+    idle_input = -1
+
     def __init__(self, code, id_):
         super().__init__(code)
         self.id = id_
@@ -14,7 +18,9 @@ class NIC(intcode.IntCode):
         self.packet = []
         self.others = []
         self.nat = None
+        self.network = None
         self.is_idle = False
+        self.is_parked = False
 
     def pop_input(self):
         if self.inputs:
@@ -27,6 +33,8 @@ class NIC(intcode.IntCode):
         self.inputs.append(x)
         self.inputs.append(y)
         self.is_idle = False
+        if self.network:
+            self.network.wake(self)
 
     def output(self, value):
         self.is_idle = False
@@ -50,35 +58,92 @@ class NAT(intcode.IntCode):
     def receive_packet(self, x, y):
         self.packet = (x, y)
 
+    def deliver(self):
+        """Wake up NIC 0 with the last packet.
+
+        Returns y if it was delivered twice in a row, else None."""
+        if not self.packet:
+            print('Would de-idle but no packet')
+            return None
+        x, y = self.packet
+        print(f'NAT is de-idling {x} {y}')
+        self.nics[0].receive_packet(x, y)
+        if y == self.last_y:
+            print(f'Delivered {y} twice in a row')
+            return y
+        self.last_y = y
+        return None
+
     def send_if_idle(self):
         if all(nic.is_idle for nic in self.nics):
-            if not self.packet:
-                print('Would de-idle but no packet')
-                return
-            x, y = self.packet
-            print(f'NAT is de-idling {x} {y}')
-            nics[0].receive_packet(x, y)
-            if y == self.last_y:
-                print(f'Delivered {y} twice in a row')
+            if self.deliver() is not None:
                 sys.exit(0)
-            self.last_y = y
 
 
-if __name__ == '__main__':
-    memory = intcode.read_memory(fileinput.input())
-    nics = [NIC(memory, i) for i in range(50)]
-    nat = NAT(nics)
+class Network:
+    """Runs each NIC until it blocks on empty input.
 
-    for nic in nics:
-        nic.others = nics
-        nic.nat = nat
+    A NIC which asks for input with an empty queue runs its poll loop once
+    (reading -1). If that provably changed nothing, it's idle: it gets
+    parked until a packet arrives for it. A NIC whose poll loop can't be
+    proven idle (e.g. it counts its polls) gives up its turn after each
+    poll instead. The NAT fires once every NIC is parked or polling with
+    nothing to read.
+    """
 
-    step = 0
-    while True:
+    def __init__(self, nics, nat, batch_size=100_000):
+        self.nics = nics
+        self.nat = nat
+        self.batch_size = batch_size
+        self.ready = deque(nics)
         for nic in nics:
-            nic.run_one_instruction()
-        nat.send_if_idle()
+            nic.others = nics
+            nic.nat = nat
+            nic.network = self
+
+    def wake(self, nic):
+        if nic.is_parked:
+            nic.is_parked = False
+            self.ready.append(nic)
+
+    def run_nic(self, nic):
+        while True:
+            status = nic.run_until_blocked(self.batch_size)
+            if status == intcode.NEEDS_INPUT:
+                if nic.prove_idle():
+                    nic.is_idle = nic.is_parked = True
+                else:
+                    # Back at an empty INPUT means it only polled; a
+                    # failed proof stopped at an OUTPUT is about to send.
+                    nic.is_idle = (
+                        nic.memory[nic.instruction_ptr] % 100 == intcode.INPUT
+                        and not nic.has_input()
+                    )
+                    self.ready.append(nic)
+                return
+            elif status == intcode.BUDGET_EXHAUSTED:
+                self.ready.append(nic)  # Give the others a turn.
+                return
+            elif status == intcode.HALTED:
+                return
+
+    def run(self):
+        """Run until the NAT delivers the same y twice in a row; return it."""
+        while True:
+            while self.ready and not all(nic.is_idle for nic in self.nics):
+                self.run_nic(self.ready.popleft())
+            if not self.nat.packet:
+                raise ValueError('Network is deadlocked')
+            y = self.nat.deliver()
+            if y is not None:
+                return y
 
-        step += 1
-        if step % 10_000 == 0:
-            print(f'Completed {step} steps...')
+
+if __name__ == '__main__':
+    # One copy of the program, shared by every NIC until it writes.
+    image = intcode.make_image(intcode.read_memory(fileinput.input()))
+    nics = [NIC(image, i) for i in range(50)]
+    nat = NAT(nics)
+    y = Network(nics, nat).run()
+    print(intcode.footprint(nics))
+    print(y)
@@ -0,0 +1,77 @@
+import pytest
+
+import day23
+
+
+def relay(n):
+    """A NIC program for n NICs. NIC i passes each packet it gets on to NIC
+    i + 1, or to the NAT from the last NIC. NIC 0 starts things off by
+    sending (7, 42) to NIC 1."""
+    return [
+        3, 100,  # 0: [100] = id
+        1001, 100, 1, 104,  # 2: [104] = id + 1, where packets go
+        1008, 104, n, 105,  # 6: last NIC?
+        1006, 105, 17,  # 10
+        1101, 255, 0, 104,  # 13: the last NIC sends to the NAT
+        1005, 100, 26,  # 17: only NIC 0 sends the first packet
+        4, 104, 104, 7, 104, 42,  # 20
+        3, 101,  # 26: [101] = x, polling until it isn't -1
+        1008, 101, -1, 103,  # 28
+        1005, 103, 26,  # 32
+        3, 102,  # 35: [102] = y
+        4, 104, 4, 101, 4, 102,  # 37: send it on
+        1105, 1, 26,  # 43
+    ]
+
+
+def counting_relay(n):
+    """relay() with a poll counter at 110, so polls are never provably
+    idle."""
+    program = relay(n)
+    return program[:26] + [1001, 110, 1, 110] + program[26:]
+
+
+def make_network(n, ids, program=relay):
+    nics = [day23.NIC(program(n), id_) for id_ in ids]
+    nat = day23.NAT(nics)
+    return nics, nat, day23.Network(nics, nat)
+
+
+def test_park_and_wake():
+    nics, nat, network = make_network(3, [1, 2, 3])
+    network.ready.clear()
+    network.run_nic(nics[1])
+    assert nics[1].is_idle and nics[1].is_parked
+    nics[1].receive_packet(5, 6)
+    assert not nics[1].is_parked
+    assert list(network.ready) == [nics[1]]
+    network.run_nic(network.ready.popleft())
+    assert nat.packet == (5, 6)  # NIC 2 is the last one
+    assert nics[1].is_parked
+
+
+def test_nat_fires_when_idle():
+    nics, nat, network = make_network(4, range(4))
+    # The packet goes round once, the NAT sends it back to NIC 0, it goes
+    # round again and the NAT sees the same y twice.
+    assert network.run() == 42
+    assert nat.packet == (7, 42)
+    assert all(nic.is_parked for nic in nics[1:])
+
+
+def test_deadlock():
+    # Without NIC 0 nobody ever sends anything.
+    _, _, network = make_network(3, [1, 2, 3])
+    with pytest.raises(ValueError, match='deadlocked'):
+        network.run()
+
+
+def test_polling_counter():
+    nics, nat, network = make_network(4, range(4), counting_relay)
+    assert network.run() == 42
+    assert not any(nic.is_parked for nic in nics)
+    assert nics[3].memory[110] > 1
+
+    _, _, network = make_network(3, [1, 2, 3], counting_relay)
+    with pytest.raises(ValueError, match='deadlocked'):
+        network.run()
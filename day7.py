@@ -1,132 +1,32 @@
 #!/usr/bin/env python
 
 import fileinput
-import itertools
-
-
-ADD = 1
-MULTIPLY = 2
-INPUT = 3
-OUTPUT = 4
-JUMP_IF_TRUE = 5
-JUMP_IF_FALSE = 6
-LESS_THAN = 7
-EQUALS = 8
-STOP = 99
-
-
-NUM_PARAMS = {
-    ADD: 3,
-    MULTIPLY: 3,
-    INPUT: 1,
-    OUTPUT: 1,
-    JUMP_IF_TRUE: 2,
-    JUMP_IF_FALSE: 2,
-    LESS_THAN: 3,
-    EQUALS: 3,
-    STOP: 0
-}
-
-MODE_POS = 0
-MODE_IMM = 1
-
-
-def decode_instruction(instruction):
-    opcode = instruction % 100
-    num_params = NUM_PARAMS[opcode]
-    modes = [MODE_POS] * num_params
-    instruction //= 100
-    i = 0
-    while instruction:
-        modes[i] = instruction % 10
-        instruction //= 10
-        i += 1
-    return opcode, modes
-
-
-class IntCode:
-    def __init__(self, memory, inputs=None):
-        self.memory = memory[:]
-        self.instruction_ptr = 0
-        self.inputs = inputs or []
-        self.outputs = []
-        self.is_halted = False
-
-    def pop_input(self):
-        v, *rest = self.inputs
-        self.inputs = rest
-        return v
-
-    def run_one_instruction(self):
-        m = self.memory
-        instruction = m[self.instruction_ptr]
-        opcode, modes = decode_instruction(instruction)
-
-        if opcode == STOP:
-            self.is_halted = True
-            return
 
-        num_params = len(modes)
-        parameters = m[
-            self.instruction_ptr + 1:self.instruction_ptr + 1 + num_params
-        ]
-
-        vals = [
-            v if mode == MODE_IMM else m[v]
-            for v, mode in zip(parameters, modes)
-        ]
-
-        self.instruction_ptr += 1 + len(parameters)
-
-        if opcode == ADD:
-            m[parameters[2]] = vals[0] + vals[1]
-        elif opcode == MULTIPLY:
-            m[parameters[2]] = vals[0] * vals[1]
-        elif opcode == INPUT:
-            val = self.pop_input()
-            m[parameters[0]] = val
-        elif opcode == OUTPUT:
-            self.outputs.append(vals[0])
-        elif opcode == JUMP_IF_TRUE:
-            if vals[0] != 0:
-                self.instruction_ptr = vals[1]
-        elif opcode == JUMP_IF_FALSE:
-            if vals[0] == 0:
-                self.instruction_ptr = vals[1]
-        elif opcode == LESS_THAN:
-            m[parameters[2]] = 1 if vals[0] < vals[1] else 0
-        elif opcode == EQUALS:
-            m[parameters[2]] = 1 if vals[0] == vals[1] else 0
-        else:
-            raise ValueError(f'Invalid opcode: {opcode}')
-
-    def run(self):
-        """Run to halt. Returns outputs."""
-        while not self.is_halted:
-            self.run_one_instruction()
-
-        return self.outputs
-
-    def run_to_output(self):
-        """Run until the program outputs.
-
-        Returns that output or None if the program halts before output."""
-        self.outputs = []
-        while not self.is_halted and not self.outputs:
-            self.run_one_instruction()
-
-        return self.outputs[0] if self.outputs else None
-
-
-def read_memory(inp):
-    text = ''.join(line for line in inp)
-    return [int(x) for x in text.split(',')]
+from intcode import NEEDS_INPUT, STOP, Dataflow, IntCode, read_memory
 
 
 def run_amps(memory, phase_settings):
-    signal = 0
     amps = [IntCode(memory, inputs=[setting]) for setting in phase_settings]
+    return run_loop(amps, 0)
+
+
+def amp_network(memory, phase_settings):
+    """The amps as a Dataflow ring, with 0 waiting for the first.
+
+    After run(), the last signal is left in the first amp's inputs."""
+    flow = Dataflow()
+    for i, setting in enumerate(phase_settings):
+        flow.add_node(i, IntCode(memory, inputs=[setting]))
+        if i:
+            flow.add_edge(i - 1, i)
+    flow.add_edge(i, 0)
+    flow.nodes[0].inputs.push(0)
+    return flow
+
 
+def run_loop(amps, signal):
+    """Pass signal round the amps until one of them halts. Returns the last
+    signal."""
     is_halted = False
     while not is_halted:
         for i, amp in enumerate(amps):
@@ -140,9 +40,52 @@ def run_amps(memory, phase_settings):
     return signal
 
 
+def search_amps(memory, phases):
+    """The best (signal, settings) for any ordering of phases.
+
+    This is the max of (run_amps(), settings) over every permutation, but
+    walks the permutations depth-first. An amp's first run (up to its
+    first output) only depends on the phases before it, so it happens once
+    per prefix and later amps carry on from there. Only what's left of a
+    feedback loop runs once per permutation, on forks of the amps. Each
+    amp starts as a fork of one that has already read its phase.
+    """
+    base = IntCode(memory)
+    primed = {}
+    for phase in phases:
+        amp = base.fork()
+        amp.inputs = [phase]
+        if amp.run_until_blocked() != NEEDS_INPUT:
+            amp = base.fork()
+            amp.inputs = [phase]
+        primed[phase] = amp
+    best = None
+
+    def visit(amps, settings, signal):
+        nonlocal best
+        remaining = [phase for phase in phases if phase not in settings]
+        if not remaining:
+            first = amps[0]
+            if first.memory[first.instruction_ptr] % 100 != STOP:
+                signal = run_loop([amp.fork() for amp in amps], signal)
+            best = max(best or (signal, settings), (signal, settings))
+            return
+        for phase in remaining:
+            amp = primed[phase].fork()
+            amp.inputs += [signal]
+            output = amp.run_to_output()
+            if output is None:
+                # Halted, so the chain stops here whatever comes after.
+                rest = tuple(sorted(set(remaining) - {phase}, reverse=True))
+                result = (signal, settings + (phase,) + rest)
+                best = max(best or result, result)
+                continue
+            visit(amps + [amp], settings + (phase,), output)
+
+    visit([], (), 0)
+    return best
+
+
 if __name__ == '__main__':
     memory = read_memory(fileinput.input())
-    print(max(
-        (run_amps(memory, settings), settings)
-        for settings in itertools.permutations(range(5, 10))
-    ))
+    print(search_amps(memory, range(5, 10)))
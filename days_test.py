@@ -0,0 +1,109 @@
+import itertools
+import random
+
+import day2
+import day5
+import day7
+import day9
+import day11
+import day15
+import day17
+import day19
+import intcode
+from intcode_test import read_day
+
+
+# Outputs of each day's own interpreter from before they shared intcode.py.
+
+def test_day2():
+    memory = read_day(2)
+    assert day2.find_inputs(memory, 19690720) == (77, 49)
+    assert day2.find_inputs(memory, 3516593) == (12, 2)
+
+
+def test_day5():
+    assert day5.run_program(read_day(5), [1]) == [0] * 9 + [10987514]
+    assert day5.run_program(read_day(5), [5]) == [14195011]
+
+
+def test_day7():
+    memory = read_day(7)
+    assert max(
+        (day7.run_amps(memory, settings), settings)
+        for settings in itertools.permutations(range(5))
+    ) == (17406, (2, 4, 1, 0, 3))
+    assert max(
+        (day7.run_amps(memory, settings), settings)
+        for settings in itertools.permutations(range(5, 10))
+    ) == (1047153, (7, 8, 6, 9, 5))
+    assert day7.search_amps(memory, range(5)) == (17406, (2, 4, 1, 0, 3))
+    assert day7.search_amps(memory, range(5, 10)) == (
+        1047153, (7, 8, 6, 9, 5))
+
+    flow = day7.amp_network(memory, (7, 8, 6, 9, 5))
+    assert flow.run() == intcode.HALTED
+    assert flow.nodes[0].inputs == [1047153]
+    assert flow.counts[4, 0] == 10
+
+    # output = 3 * signal + phase, or halt without output on phase 0.
+    chain = [3, 20, 1005, 20, 7, 99, 0, 3, 21, 1002, 21, 3, 21, 1, 21, 20,
+             21, 4, 21, 99, 0, 0]
+    assert day7.search_amps(chain, range(6)) == max(
+        (day7.run_amps(chain, settings), settings)
+        for settings in itertools.permutations(range(6))
+    )
+
+
+def test_day9():
+    assert day9.IntCode(read_day(9), [1]).run() == [3280416268]
+
+
+HULL = '''\
+.#..#.####..##..####.#..#.###..#....###....
+.#..#....#.#..#.#....#.#..#..#.#....#..#...
+.#..#...#..#..#.###..##...###..#....#..#...
+.#..#..#...####.#....#.#..#..#.#....###....
+.#..#.#....#..#.#....#.#..#..#.#....#......
+..##..####.#..#.####.#..#.###..####.#......
+'''
+
+
+def test_day11(capsys, tmp_path, monkeypatch):
+    monkeypatch.setattr(intcode, 'AOT_CACHE_DIR', str(tmp_path))
+    robot = day11.HullPaintingRobot(read_day(11))
+    robot.run()
+    assert len(robot.colors) == 249
+    day11.print_hull(robot.colors)
+    assert capsys.readouterr().out == HULL
+
+    canvas = day11.TurboRobot(read_day(11)).paint()
+    assert len(canvas) == 249
+    assert canvas.render() == HULL
+    assert len(day11.TurboRobot(read_day(11), start_color=0).paint()) == 2336
+
+
+def test_day15():
+    droid = day15.RepairDroid(read_day(15))
+    rng = random.Random(15)
+    for _ in range(3000):
+        droid.exec(rng.choice([1, 2, 3, 4]))
+    assert (droid.x, droid.y) == (2, 2)
+    assert droid.oxygen is None
+    assert len(droid.area) == 82
+    assert sum(1 for v in droid.area.values() if v == day15.WALL) == 52
+
+
+def test_day17():
+    outputs = day17.IntCode(read_day(17)).run()
+    assert len(outputs) == 2251
+    assert day17.sum_alignments(day17.make_grid(outputs)) == 5680
+
+
+def test_day19(tmp_path, monkeypatch):
+    monkeypatch.setattr(intcode, 'AOT_CACHE_DIR', str(tmp_path))
+    memory = read_day(19)
+    assert sum(
+        day19.is_affected(memory, x, y)
+        for x in range(50) for y in range(50)
+    ) == 231
+    assert day19.find_edges(memory, 100, int(day19.SLOPE * 100)) == (110, 136)
@@ -1,6 +1,21 @@
 """The elves' favorite computer."""
 
-from collections import defaultdict
+from array import array
+from collections import Counter, OrderedDict, deque, namedtuple
+from multiprocessing import shared_memory, util
+import asyncio
+import bisect
+import copy
+import hashlib
+import importlib.util
+import json
+import mmap
+import multiprocessing
+import os
+import tempfile
+import time
+
+import numpy as np
 
 
 ADD = 1
@@ -28,16 +43,37 @@ NUM_PARAMS = {
     STOP: 0
 }
 
+OPCODE_NAMES = {
+    ADD: 'ADD',
+    MULTIPLY: 'MULTIPLY',
+    INPUT: 'INPUT',
+    OUTPUT: 'OUTPUT',
+    JUMP_IF_TRUE: 'JUMP_IF_TRUE',
+    JUMP_IF_FALSE: 'JUMP_IF_FALSE',
+    LESS_THAN: 'LESS_THAN',
+    EQUALS: 'EQUALS',
+    ADJUST_RELATIVE_BASE: 'ADJUST_RELATIVE_BASE',
+    STOP: 'STOP',
+}
+
+MAX_INSTRUCTION_LENGTH = 1 + max(NUM_PARAMS.values())
+
 MODE_POS = 0
 MODE_IMM = 1
 MODE_REL = 2
 
 
 def decode_instruction(instruction):
+    """(opcode, [mode of each parameter]). Raises ValueError for words
+    which aren't instructions."""
     opcode = instruction % 100
-    num_params = NUM_PARAMS[opcode]
+    num_params = NUM_PARAMS.get(opcode)
+    if num_params is None:
+        raise ValueError(f'Invalid opcode: {opcode}')
     modes = [MODE_POS] * num_params
     instruction //= 100
+    if not 0 <= instruction < 10 ** num_params:
+        raise ValueError(f'Invalid modes for opcode {opcode}: {instruction}')
     i = 0
     while instruction:
         modes[i] = instruction % 10
@@ -46,23 +82,1477 @@ def decode_instruction(instruction):
     return opcode, modes
 
 
+# instruction -> (opcode, modes), for the interpreter. Only ever holds
+# instructions decode_instruction() accepted, all below 100000.
+_decoded_instructions = {}
+
+
+PAGE_BITS = 10
+PAGE_SIZE = 1 << PAGE_BITS
+PAGE_MASK = PAGE_SIZE - 1
+
+INT64_MAX = (1 << 63) - 1
+# Cells holding this value keep their real (too big) value in PagedMemory.big.
+OVERFLOW = -(1 << 63)
+
+
+def _new_page():
+    return array('q', bytes(8 * PAGE_SIZE))
+
+
+class PagedMemory:
+    """Intcode memory made of fixed-size pages of packed 64-bit cells.
+
+    Pages are only allocated when a non-zero value is written to them, so
+    reading far-away addresses is free. Values which don't fit in 64 bits
+    fall back to Python ints in the `big` dict.
+
+    Pages shared with a fork are read-only memoryviews; the first write to
+    one copies it.
+    """
+
+    def __init__(self, values=()):
+        self.pages = {}  # page number -> array('q')
+        self.big = {}  # address -> int, for cells which overflow
+        if isinstance(values, ProgramImage):
+            self.pages = dict(values.pages())
+        elif hasattr(values, 'items'):
+            for addr, value in values.items():
+                self[addr] = value
+        else:
+            self.load(values)
+
+    def load(self, values, start=0):
+        """Write a sequence of values starting at address start."""
+        values = list(values)
+        if start & PAGE_MASK:
+            for addr, value in enumerate(values, start):
+                self[addr] = value
+            return
+        for i in range(0, len(values), PAGE_SIZE):
+            chunk = values[i:i + PAGE_SIZE]
+            try:
+                page = array('q', chunk)
+            except OverflowError:
+                for addr, value in enumerate(chunk, start + i):
+                    self[addr] = value
+                continue
+            if OVERFLOW in page:
+                for addr, value in enumerate(chunk, start + i):
+                    self[addr] = value
+                continue
+            if len(page) < PAGE_SIZE:
+                page.frombytes(bytes(8 * (PAGE_SIZE - len(page))))
+            self.pages[(start + i) >> PAGE_BITS] = page
+
+    def __getitem__(self, addr):
+        page = self.pages.get(addr >> PAGE_BITS)
+        if page is None:
+            return 0
+        value = page[addr & PAGE_MASK]
+        if value == OVERFLOW:
+            return self.big[addr]
+        return value
+
+    def __setitem__(self, addr, value):
+        page = self.pages.get(addr >> PAGE_BITS)
+        if page is None:
+            if not value:
+                return
+            page = self.pages[addr >> PAGE_BITS] = _new_page()
+        i = addr & PAGE_MASK
+        if page[i] == OVERFLOW:
+            del self.big[addr]
+        if not OVERFLOW < value <= INT64_MAX:
+            self.big[addr] = value
+            value = OVERFLOW
+        try:
+            page[i] = value
+        except TypeError:
+            # A read-only page shared with a fork: copy it.
+            page = self.pages[addr >> PAGE_BITS] = array('q', page.tobytes())
+            page[i] = value
+
+    def freeze(self):
+        """Make every page copy-on-write and return {page number: page}.
+
+        A page written to afterwards is replaced by a copy, so comparing the
+        returned pages with self.pages by identity finds what changed."""
+        pages = self.pages
+        for n, page in pages.items():
+            if isinstance(page, array):
+                pages[n] = memoryview(page).toreadonly()
+        return dict(pages)
+
+    def fork(self):
+        """A copy of this memory which shares pages until either writes."""
+        child = PagedMemory()
+        child.pages = self.freeze()
+        child.big = dict(self.big)
+        return child
+
+    def get(self, addr, default=0):
+        page = self.pages.get(addr >> PAGE_BITS)
+        return default if page is None else self[addr]
+
+    def items(self):
+        """(address, value) for every non-zero cell, in address order."""
+        for n in sorted(self.pages):
+            base = n << PAGE_BITS
+            for i, value in enumerate(self.pages[n]):
+                if value:
+                    addr = base + i
+                    yield addr, self.big[addr] if value == OVERFLOW else value
+
+    @property
+    def resident_pages(self):
+        return len(self.pages)
+
+    @property
+    def private_pages(self):
+        """Pages this memory has written to since it was last forked."""
+        return sum(1 for page in self.pages.values() if type(page) is array)
+
+    @property
+    def resident_bytes(self):
+        """Approximate bytes held by pages plus overflowed cells."""
+        return (
+            len(self.pages) * 8 * PAGE_SIZE +
+            sum(8 + v.bit_length() // 8 for v in self.big.values())
+        )
+
+
+IMAGE_MAGIC = b'INTCODE\x01'
+IMAGE_SUFFIX = '.img'
+# Stored in the header so images from a machine with a different byte order
+# are rebuilt rather than misread.
+IMAGE_BYTE_ORDER = 0x0102030405060708
+IMAGE_HEADER = len(IMAGE_MAGIC) + 32 + 8 + 8  # magic, sha256, order, length
+
+
+class ProgramImage:
+    """A read-only Intcode program in packed 64-bit cells.
+
+    The cells are padded to a whole number of pages, so PagedMemory can use
+    them as its (copy-on-write) pages without copying anything.
+    """
+
+    def __init__(self, cells, length, digest=None):
+        self.cells = cells  # memoryview with format 'q'
+        self.length = length
+        self.digest = digest
+
+    def pages(self):
+        for n in range(len(self.cells) // PAGE_SIZE):
+            yield n, self.cells[n * PAGE_SIZE:(n + 1) * PAGE_SIZE]
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self.cells[j] for j in range(*i.indices(self.length))]
+        if not -self.length <= i < self.length:
+            raise IndexError('ProgramImage index out of range')
+        return self.cells[i % self.length]
+
+    def __iter__(self):
+        return iter(self.cells[:self.length].tolist())
+
+
+def _write_atomically(path, chunks):
+    """Write chunks of bytes to path via a temporary file and a rename, so
+    readers see either the old file or the whole new one."""
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or '.')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            for chunk in chunks:
+                f.write(chunk)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def _pack_image(memory):
+    """memory as 64-bit cells padded to whole pages, or None if it won't
+    fit."""
+    try:
+        cells = array('q', memory)
+    except OverflowError:
+        return None
+    if OVERFLOW in cells:
+        return None
+    cells.frombytes(bytes(8 * (-len(cells) % PAGE_SIZE)))
+    return cells
+
+
+def _write_image(path, memory, digest):
+    """Atomically write memory as a binary image. False if it won't fit."""
+    cells = _pack_image(memory)
+    if cells is None:
+        return False
+    header = array('q', [IMAGE_BYTE_ORDER, len(memory)])
+    _write_atomically(path, [IMAGE_MAGIC, digest, header, cells])
+    return True
+
+
+def _map_image(path, digest):
+    """Memory map an image, or return None if it's missing or stale."""
+    try:
+        with open(path, 'rb') as f:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError):
+        return None
+    view = memoryview(mapped)
+    if (
+        len(view) < IMAGE_HEADER or
+        view[:len(IMAGE_MAGIC)] != IMAGE_MAGIC or
+        view[len(IMAGE_MAGIC):len(IMAGE_MAGIC) + 32] != digest
+    ):
+        return None
+    order, length = view[len(IMAGE_MAGIC) + 32:IMAGE_HEADER].cast('q')
+    cells = view[IMAGE_HEADER:]
+    if order != IMAGE_BYTE_ORDER or len(cells) % (8 * PAGE_SIZE):
+        return None
+    return ProgramImage(cells.cast('q'), length, digest)
+
+
+def load_image(path):
+    """Load the program in a text file like inputs/day9.txt.
+
+    The parsed program is cached as a binary image next to the source
+    (path + IMAGE_SUFFIX), keyed by the source's sha256. Later loads just
+    memory map it and return a zero-copy ProgramImage. Falls back to a plain
+    list if the program doesn't fit in 64-bit cells.
+    """
+    with open(path, 'rb') as f:
+        source = f.read()
+    digest = hashlib.sha256(source).digest()
+    image_path = path + IMAGE_SUFFIX
+    image = _map_image(image_path, digest)
+    if image:
+        return image
+
+    memory = read_memory(source.decode())
+    try:
+        if not _write_image(image_path, memory, digest):
+            return memory
+    except OSError:
+        return memory  # e.g. a read-only directory
+    return _map_image(image_path, digest) or memory
+
+
+def make_image(memory):
+    """An immutable in-process ProgramImage of memory (a list of ints).
+
+    Machines built from one image share its pages, each keeping private
+    copies of just the pages it writes to. Returns memory itself if it
+    doesn't fit in 64-bit cells."""
+    cells = _pack_image(memory)
+    if cells is None:
+        return memory
+    return ProgramImage(memoryview(cells).toreadonly(), len(memory))
+
+
+def create_shared_image(memory):
+    """Copy memory into a new multiprocessing.shared_memory segment.
+
+    Other processes can open it by name and map it with shared_image().
+    The caller must close() and unlink() the segment once they're done.
+    Returns None if memory doesn't fit in 64-bit cells."""
+    cells = _pack_image(memory)
+    if cells is None:
+        return None
+    segment = shared_memory.SharedMemory(
+        create=True, size=len(cells) * cells.itemsize)
+    segment.buf[:len(cells) * cells.itemsize] = cells.tobytes()
+    return segment
+
+
+def shared_image(segment, length):
+    """A read-only ProgramImage of the program of the given length in a
+    create_shared_image() segment.
+
+    The segment can't be closed while any machine built from the image is
+    still around."""
+    size = -length % PAGE_SIZE + length
+    cells = segment.buf.toreadonly()[:8 * size].cast('q')
+    return ProgramImage(cells, length)
+
+
+def footprint(machines):
+    """The memory used by a group of machines between them.
+
+    Read-only pages (from a program image, or shared with a fork) are
+    counted once however many machines use them; pages a machine has
+    written to are private to it."""
+    shared = {}
+    private_bytes = 0
+    for machine in machines:
+        memory = machine.memory
+        for page in memory.pages.values():
+            if type(page) is array:
+                private_bytes += 8 * len(page)
+            else:
+                shared[id(page.obj)] = page.obj
+        private_bytes += sum(
+            8 + v.bit_length() // 8 for v in memory.big.values())
+    return {
+        'machines': len(machines),
+        'shared_bytes': sum(
+            memoryview(obj).nbytes for obj in shared.values()),
+        'private_bytes': private_bytes,
+        'private_bytes_per_machine': private_bytes // max(len(machines), 1),
+    }
+
+
+CHECKPOINT_MAGIC = b'INTCKPT\x01'
+
+
+def _write_checkpoint(path, meta, pages):
+    """Atomically write a checkpoint: a header, JSON metadata (registers,
+    I/O queues and so on) and then (page number, cells) for each page."""
+    meta = json.dumps(meta).encode()
+    header = array('q', [IMAGE_BYTE_ORDER, len(meta), len(pages)])
+    chunks = [CHECKPOINT_MAGIC, header, meta]
+    for n, page in sorted(pages.items()):
+        chunks += [array('q', [n]), page]
+    _write_atomically(path, chunks)
+
+
+def _read_checkpoint(path):
+    """Read a checkpoint and (for an incremental one) its parents.
+
+    Returns its metadata and {page number: page} for the whole memory."""
+    with open(path, 'rb') as f:
+        data = f.read()
+    start = len(CHECKPOINT_MAGIC)
+    if data[:start] != CHECKPOINT_MAGIC:
+        raise ValueError(f'Not a checkpoint: {path}')
+    view = memoryview(data)
+    order, meta_length, num_pages = view[start:start + 24].cast('q')
+    if order != IMAGE_BYTE_ORDER:
+        raise ValueError(f'Checkpoint from a different byte order: {path}')
+    start += 24
+    meta = json.loads(data[start:start + meta_length])
+    start += meta_length
+
+    pages = {}
+    parent = meta['parent']
+    if parent:
+        parent_path = os.path.join(os.path.dirname(path), parent['path'])
+        parent_meta, pages = _read_checkpoint(parent_path)
+        if parent_meta['id'] != parent['id']:
+            raise ValueError(f'{parent_path} was replaced after {path}')
+    page_bytes = 8 * PAGE_SIZE
+    for _ in range(num_pages):
+        n = view[start:start + 8].cast('q')[0]
+        page = pages[n] = array('q')
+        page.frombytes(view[start + 8:start + 8 + page_bytes])
+        start += 8 + page_bytes
+    return meta, pages
+
+
+class Channel:
+    """A FIFO queue of Intcode values with O(1) push and pop.
+
+    Machines read inputs from one channel and write outputs to another.
+    Giving two machines the same channel (see connect()) wires them together
+    without copying anything. With a capacity, pushing onto a full channel
+    raises ValueError; producers can check is_full first. If set, listener()
+    is called after values are pushed, e.g. to wake up a parked reader.
+    """
+
+    def __init__(self, values=(), capacity=None):
+        self.queue = deque(values)
+        self.capacity = capacity
+        self.listener = None
+        if capacity is not None and len(self.queue) > capacity:
+            raise ValueError(f'Channel is full (capacity {capacity})')
+
+    def push(self, value):
+        if self.capacity is not None and len(self.queue) >= self.capacity:
+            raise ValueError(f'Channel is full (capacity {self.capacity})')
+        self.queue.append(value)
+        if self.listener:
+            self.listener()
+
+    append = push
+
+    def extend(self, values):
+        if self.capacity is None:
+            self.queue.extend(values)
+            if self.listener and self.queue:
+                self.listener()
+        else:
+            for value in values:
+                self.push(value)
+
+    def pop(self):
+        """Remove and return the oldest value."""
+        if not self.queue:
+            raise ValueError('Channel is empty')
+        return self.queue.popleft()
+
+    def drain(self):
+        """Remove and return all the values, oldest first."""
+        values = list(self.queue)
+        self.queue.clear()
+        return values
+
+    def clear(self):
+        self.queue.clear()
+
+    @property
+    def is_full(self):
+        return self.capacity is not None and len(self.queue) >= self.capacity
+
+    def __len__(self):
+        return len(self.queue)
+
+    def __bool__(self):
+        return bool(self.queue)
+
+    def __iter__(self):
+        return iter(self.queue)
+
+    def __getitem__(self, i):
+        return self.queue[i]
+
+    def __iadd__(self, values):
+        self.extend(values)
+        return self
+
+    def __eq__(self, other):
+        if isinstance(other, Channel):
+            other = other.queue
+        try:
+            return list(self.queue) == list(other)
+        except TypeError:
+            return NotImplemented
+
+    def __repr__(self):
+        return f'Channel({list(self.queue)})'
+
+
+# Why run_until_blocked() (or run(), for the last three) stopped.
+NEEDS_INPUT = 'needs_input'
+HAS_OUTPUT = 'has_output'
+OUTPUT_FULL = 'output_full'
+HALTED = 'halted'
+BUDGET_EXHAUSTED = 'budget_exhausted'
+DEADLINE_EXCEEDED = 'deadline_exceeded'
+
+# How many instructions run() with limits runs between checking them.
+RUN_CHECK_STEPS = 10_000
+
+# Names visible to generated handlers and blocks.
+_CODEGEN_GLOBALS = {
+    'NEEDS_INPUT': NEEDS_INPUT,
+    'HAS_OUTPUT': HAS_OUTPUT,
+    'OUTPUT_FULL': OUTPUT_FULL,
+    'HALTED': HALTED,
+}
+
+ENGINE_INTERPRET = 'interpret'
+ENGINE_CACHED = 'cached'
+ENGINE_COMPILED = 'compiled'
+# The compiled engine starting with every block of a program that doesn't
+# modify its code compiled ahead of time. See load_aot().
+ENGINE_AOT = 'aot'
+
+
+def _read_source(name, mode, rb='vm.relative_base'):
+    """Python expression which reads parameter `name` in the given mode."""
+    if mode == MODE_IMM:
+        return name
+    elif mode == MODE_POS:
+        return f'm[{name}]'
+    elif mode == MODE_REL:
+        return f'm[{rb} + {name}]'
+    raise ValueError(f'Invalid mode {mode}')
+
+
+def _write_source(name, mode, value, rb='vm.relative_base', on_code=()):
+    """Python statements which write `value` to parameter `name`.
+
+    Writes which land on decoded code throw away the stale handlers and then
+    run the `on_code` statements."""
+    if mode == MODE_POS and name.isdigit():
+        addr = name
+        lines = []
+    elif mode == MODE_POS:
+        addr = 'addr'
+        lines = [f'addr = {name}']
+    elif mode == MODE_REL:
+        addr = 'addr'
+        lines = [f'addr = {rb} + {name}']
+    else:
+        raise ValueError(f'Invalid mode for write: {mode}')
+    return lines + [
+        f'm[{addr}] = {value}',
+        f'if {addr} in code:',
+        f'    vm.invalidate_code({addr})',
+        *(f'    {line}' for line in on_code),
+    ]
+
+
+def _input_check_source(blocked, skipped):
+    """Python statements to run before an INPUT instruction.
+
+    They return `blocked` if the machine is blocking with no input, or
+    `skipped` if poll_idle() handled a poll with no input."""
+    return [
+        'if not vm.has_input():',
+        '    if vm.blocking:',
+        f'        return {blocked}',
+        '    if vm.idle_input is not None and vm.poll_idle():',
+        f'        return {skipped}',
+        'vm.is_idle_proven = False',
+    ]
+
+
+def _instruction_source(opcode, modes, params, next_ip):
+    """Python statements which execute one decoded instruction.
+
+    STOP and OUTPUT return HALTED and HAS_OUTPUT. While the machine is
+    blocking, INPUT returns NEEDS_INPUT (without executing) if no input is
+    available, and OUTPUT returns OUTPUT_FULL (likewise) if there's no room
+    for output; otherwise a poll with no input may be skipped by
+    poll_idle(). Everything else returns None."""
+    vals = [_read_source(p, mode) for p, mode in zip(params, modes)]
+    advance = f'vm.instruction_ptr = {next_ip}'
+
+    if opcode == STOP:
+        return ['vm.is_halted = True', 'return HALTED']
+    elif opcode == ADD:
+        return [advance] + _write_source(
+            params[2], modes[2], f'{vals[0]} + {vals[1]}')
+    elif opcode == MULTIPLY:
+        return [advance] + _write_source(
+            params[2], modes[2], f'{vals[0]} * {vals[1]}')
+    elif opcode == INPUT:
+        return _input_check_source('NEEDS_INPUT', 'None') + [
+            advance,
+            'val = vm.pop_input()',
+        ] + _write_source(params[0], modes[0], 'val')
+    elif opcode == OUTPUT:
+        return [
+            'if vm.blocking and not vm.can_output():',
+            '    return OUTPUT_FULL',
+            f'vm.output({vals[0]})',
+            advance,
+            'return HAS_OUTPUT',
+        ]
+    elif opcode == JUMP_IF_TRUE:
+        return [
+            f'vm.instruction_ptr = {vals[1]} if {vals[0]} != 0 else {next_ip}'
+        ]
+    elif opcode == JUMP_IF_FALSE:
+        return [
+            f'vm.instruction_ptr = {vals[1]} if {vals[0]} == 0 else {next_ip}'
+        ]
+    elif opcode == LESS_THAN:
+        return [advance] + _write_source(
+            params[2], modes[2], f'1 if {vals[0]} < {vals[1]} else 0')
+    elif opcode == EQUALS:
+        return [advance] + _write_source(
+            params[2], modes[2], f'1 if {vals[0]} == {vals[1]} else 0')
+    elif opcode == ADJUST_RELATIVE_BASE:
+        return [advance, f'vm.relative_base += {vals[0]}']
+    raise ValueError(f'Invalid opcode: {opcode}')
+
+
+_handler_factories = {}
+
+
+def handler_factory(opcode, modes):
+    """Build (once) a factory for handlers of this (opcode, modes) pair.
+
+    The factory takes the machine, its memory, its code map, the address of
+    the instruction and its raw parameters and returns a zero-argument
+    function which executes that one instruction."""
+    key = (opcode, tuple(modes))
+    factory = _handler_factories.get(key)
+    if factory:
+        return factory
+
+    params = [f'p{i}' for i in range(len(modes))]
+    body = _instruction_source(opcode, modes, params, 'next_ip')
+    src = '\n'.join([
+        f'def factory(vm, m, code, ip, {", ".join(params + ["next_ip"])}):',
+        '    def op():',
+        *(f'        {line}' for line in body),
+        '    op.length = 1',
+        '    return op',
+    ])
+    namespace = dict(_CODEGEN_GLOBALS)
+    exec(src, namespace)
+    factory = namespace['factory']
+    _handler_factories[key] = factory
+    return factory
+
+
+_ARITH = {ADD, MULTIPLY, LESS_THAN, EQUALS}
+_COMPARE = {LESS_THAN, EQUALS}
+_JUMP = {JUMP_IF_TRUE, JUMP_IF_FALSE}
+_ADJUST = {ADJUST_RELATIVE_BASE}
+
+# Superinstructions: (name, opcodes allowed for each instruction). The first
+# match wins. The *_branch fusions only match when the jump tests the cell
+# the comparison just wrote, and then branch on the value directly.
+FUSIONS = (
+    ('adjust_compare_branch', (_ADJUST, _COMPARE, _JUMP)),
+    ('store_store_jump', (_ARITH, _ARITH, _JUMP)),  # e.g. argument + call
+    ('compare_branch', (_COMPARE, _JUMP)),
+    ('store_jump', (_ARITH, _JUMP)),  # e.g. call
+    ('adjust_jump', (_ADJUST, _JUMP)),  # e.g. return
+    ('store_store', (_ARITH, _ARITH)),
+)
+FUSION_LENGTHS = {name: len(opcodes) for name, opcodes in FUSIONS}
+
+
+def find_fusion(m, addr):
+    """Match the instructions at addr against FUSIONS.
+
+    Returns (name, [(opcode, modes, params, next_ip)]) or None. Looking
+    ahead stops at a jump or STOP, or a word which isn't an instruction:
+    what follows may well be data."""
+    instructions = []
+    ip = addr
+    for _ in range(max(FUSION_LENGTHS.values())):
+        try:
+            opcode, modes = decode_instruction(m[ip])
+        except ValueError:
+            break
+        length = 1 + len(modes)
+        params = [m[ip + i] for i in range(1, length)]
+        ip += length
+        instructions.append((opcode, modes, params, ip))
+        if opcode in _JUMP or opcode == STOP:
+            break
+
+    for name, opcodes in FUSIONS:
+        if len(instructions) < len(opcodes) or any(
+            i[0] not in allowed for i, allowed in zip(instructions, opcodes)
+        ):
+            continue
+        fused = instructions[:len(opcodes)]
+        if name.endswith('_branch'):
+            _, modes, params, _ = fused[-2]
+            _, jump_modes, jump_params, _ = fused[-1]
+            if (jump_modes[0], jump_params[0]) != (modes[2], params[2]):
+                continue
+        return name, fused
+    return None
+
+
+_fusion_factories = {}
+
+
+def fusion_factory(name, shapes):
+    """Build (once) a factory for handlers of a fused sequence of
+    (opcode, modes) shapes.
+
+    The factory takes the machine, its memory, its code map, the address of
+    the first instruction and then the raw parameters and next instruction
+    address of each instruction in turn. Its handlers run the whole sequence
+    and count themselves in vm.fusion_counts. A write onto decoded code stops
+    the handler after that instruction, so self-modified code is never run
+    stale; the handler then returns how many instructions it ran."""
+    key = (name, shapes)
+    factory = _fusion_factories.get(key)
+    if factory:
+        return factory
+
+    args = []
+    lines = []
+    for i, (opcode, modes) in enumerate(shapes):
+        params = [f'p{i}_{j}' for j in range(len(modes))]
+        next_ip = f'n{i}'
+        args += params + [next_ip]
+        vals = [_read_source(p, mode) for p, mode in zip(params, modes)]
+        if opcode == ADJUST_RELATIVE_BASE:
+            lines.append(f'vm.relative_base += {vals[0]}')
+        elif opcode in _ARITH:
+            lines.append('v = ' + {
+                ADD: f'{vals[0]} + {vals[1]}',
+                MULTIPLY: f'{vals[0]} * {vals[1]}',
+                LESS_THAN: f'1 if {vals[0]} < {vals[1]} else 0',
+                EQUALS: f'1 if {vals[0]} == {vals[1]} else 0',
+            }[opcode])
+            lines += _write_source(params[2], modes[2], 'v', on_code=[
+                f'vm.instruction_ptr = {next_ip}',
+                f'return {i + 1}',
+            ])
+        else:
+            test = vals[0]
+            if name.endswith('_branch'):
+                test = 'v'
+            test = f'{test} != 0' if opcode == JUMP_IF_TRUE else f'{test} == 0'
+            lines.append(f'counts[{name!r}] += 1')
+            lines.append(
+                f'vm.instruction_ptr = {vals[1]} if {test} else {next_ip}')
+    if shapes[-1][0] not in _JUMP:
+        lines.append(f'counts[{name!r}] += 1')
+        lines.append(f'vm.instruction_ptr = {next_ip}')
+
+    src = '\n'.join([
+        f'def factory(vm, m, code, ip, {", ".join(args)}):',
+        '    counts = vm.fusion_counts',
+        '    def op():',
+        *(f'        {line}' for line in lines),
+        f'    op.length = {len(shapes)}',
+        '    return op',
+    ])
+    namespace = dict(_CODEGEN_GLOBALS)
+    exec(src, namespace)
+    factory = namespace['factory']
+    _fusion_factories[key] = factory
+    return factory
+
+
+MAX_BLOCK_INSTRUCTIONS = 64
+BLOCK_ENDS = {INPUT, OUTPUT, JUMP_IF_TRUE, JUMP_IF_FALSE, STOP}
+
+
+def block_source(
+    m, start, max_instructions=MAX_BLOCK_INSTRUCTIONS, dynamic=()
+):
+    """Python source for the basic block starting at address start.
+
+    The generated `block()` runs straight-line code up to and including the
+    next jump, output or halt instruction and returns the number of
+    instructions it executed. INPUT only ever starts a block: while the
+    machine is blocking and has no input (or poll_idle() handled the poll),
+    such a block returns 0 without running anything. While blocking with no
+    room for output, a block stops at its OUTPUT and returns ~n, for the n
+    instructions before it. The relative base
+    lives in a local until the block exits. Parameters at the addresses in
+    `dynamic` are read from memory when the block runs rather than being
+    baked in. Returns the source and the address just past the block.
+    """
+    lines = ['rb = vm.relative_base']
+    if m[start] % 100 == INPUT:
+        lines = _input_check_source('0', '0') + lines
+    ip = start
+    n = 0
+    last_opcode = None
+    while True:
+        instruction = m[ip]
+        opcode = instruction % 100
+        if (
+            opcode not in NUM_PARAMS or
+            n == max_instructions or
+            (opcode == INPUT and n > 0)
+        ):
+            if n == 0:
+                raise ValueError(f'Invalid opcode: {opcode}')
+            # Let the dispatcher deal with whatever comes next.
+            lines += [
+                'vm.relative_base = rb',
+                f'vm.instruction_ptr = {ip}',
+                f'return {n}',
+            ]
+            end = ip
+            break
+
+        _, modes = decode_instruction(instruction)
+        length = 1 + len(modes)
+        params = [
+            f'm[{ip + i}]' if ip + i in dynamic else str(m[ip + i])
+            for i in range(1, length)
+        ]
+        vals = [_read_source(p, mode, 'rb') for p, mode in zip(params, modes)]
+        next_ip = ip + length
+        n += 1
+        exit_lines = [
+            'vm.relative_base = rb',
+            f'vm.instruction_ptr = {next_ip}',
+            f'return {n}',
+        ]
+        lines.append(f'# {ip}: {" ".join([str(instruction)] + params)}')
+
+        if opcode in (ADD, MULTIPLY, LESS_THAN, EQUALS):
+            value = {
+                ADD: f'{vals[0]} + {vals[1]}',
+                MULTIPLY: f'{vals[0]} * {vals[1]}',
+                LESS_THAN: f'1 if {vals[0]} < {vals[1]} else 0',
+                EQUALS: f'1 if {vals[0]} == {vals[1]} else 0',
+            }[opcode]
+            lines += _write_source(
+                params[2], modes[2], value, 'rb', on_code=exit_lines)
+        elif opcode == ADJUST_RELATIVE_BASE:
+            lines.append(f'rb += {vals[0]}')
+        elif opcode == STOP:
+            lines += [
+                'vm.relative_base = rb',
+                f'vm.instruction_ptr = {ip}',
+                'vm.is_halted = True',
+                f'return {n}',
+            ]
+        elif opcode == INPUT:
+            lines += exit_lines[:2] + ['val = vm.pop_input()']
+            lines += _write_source(params[0], modes[0], 'val', 'rb')
+            lines.append(f'return {n}')
+        elif opcode == OUTPUT:
+            lines += [
+                'vm.relative_base = rb',
+                f'vm.instruction_ptr = {ip}',
+                'if vm.blocking and not vm.can_output():',
+                f'    return {~(n - 1)}',
+                f'vm.output({vals[0]})',
+                exit_lines[1],
+                f'return {n}',
+            ]
+        elif opcode in (JUMP_IF_TRUE, JUMP_IF_FALSE):
+            test = '!=' if opcode == JUMP_IF_TRUE else '=='
+            lines += [
+                'vm.relative_base = rb',
+                'vm.instruction_ptr = '
+                f'{vals[1]} if {vals[0]} {test} 0 else {next_ip}',
+                f'return {n}',
+            ]
+        ip = end = next_ip
+        last_opcode = opcode
+        if opcode in BLOCK_ENDS:
+            break
+
+    src = '\n'.join([
+        'def factory(vm, m, code):',
+        '    def block():',
+        *(f'        {line}' for line in lines),
+        f'    block.length = {n}',
+        f'    block.ends_with_output = {last_opcode == OUTPUT}',
+        f'    block.exits = {last_opcode in (OUTPUT, STOP)}',
+        '    return block',
+    ])
+    return src, end
+
+
+class Profiler:
+    """Records what an IntCode machine executes.
+
+    Attach one with `machine.profiler = Profiler()`. Machines without a
+    profiler run exactly the same code as before, so profiling costs
+    nothing when it's off. A jump whose target is the next instruction
+    counts as not taken.
+    """
+
+    def __init__(self, history=64):
+        self.opcodes = Counter()  # opcode -> executions
+        self.addresses = Counter()  # address -> executions
+        self.branches = {}  # address of jump -> [taken, not taken]
+        # (address, instruction, relative base) of the last instructions
+        self.history = deque(maxlen=history)
+
+    def record(self, ip, instruction, relative_base, next_ip):
+        opcode = instruction % 100
+        self.opcodes[opcode] += 1
+        self.addresses[ip] += 1
+        self.history.append((ip, instruction, relative_base))
+        if opcode == JUMP_IF_TRUE or opcode == JUMP_IF_FALSE:
+            counts = self.branches.get(ip)
+            if counts is None:
+                counts = self.branches[ip] = [0, 0]
+            counts[0 if next_ip != ip + 3 else 1] += 1
+
+    def hot_addresses(self, n=20):
+        return self.addresses.most_common(n)
+
+    def to_json(self):
+        return {
+            'opcodes': {
+                OPCODE_NAMES.get(opcode, str(opcode)): count
+                for opcode, count in self.opcodes.most_common()
+            },
+            'addresses': {
+                str(addr): count for addr, count in self.hot_addresses(None)
+            },
+            'branches': {
+                str(addr): {
+                    'taken': taken,
+                    'not_taken': not_taken,
+                    'taken_ratio': taken / (taken + not_taken),
+                }
+                for addr, (taken, not_taken) in sorted(self.branches.items())
+            },
+            'history': [list(entry) for entry in self.history],
+        }
+
+    def dump(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.to_json(), f, indent=2)
+
+
+def find_calls(m):
+    """Find subroutine calls in a program.
+
+    Programs call a subroutine by storing the return address at [rb+0]
+    (an ADD or MULTIPLY of two immediates) and then jumping to it with an
+    unconditional jump, returning to the instruction after the jump.
+    Returns {subroutine address: {return addresses}}. Every address is
+    scanned, so data can produce false positives; Memoizer checks [rb+0]
+    at run time anyway.
+    """
+    calls = {}
+    for addr, instruction in m.items():
+        if instruction not in (21101, 21102) or m[addr + 3] != 0:
+            continue
+        a, b = m[addr + 1], m[addr + 2]
+        ret = a + b if instruction == 21101 else a * b
+        jump, condition = m[addr + 4], m[addr + 5]
+        if ret == addr + 7 and (
+            jump == 1105 and condition != 0 or
+            jump == 1106 and condition == 0
+        ):
+            calls.setdefault(m[addr + 6], set()).add(ret)
+    return calls
+
+
+# Most instructions Memoizer will trace through one subroutine call.
+MEMO_TRACE_STEPS = 100_000
+# Deepest nesting of calls which are looked up (or traced) separately.
+MEMO_MAX_DEPTH = 100
+# Default number of results a Memoizer keeps.
+MEMO_SIZE = 4096
+
+# What one subroutine call did. reads and writes are (cell, value) pairs,
+# where a cell is (True, offset from the relative base at the call) or
+# (False, address). code is the (start, end) of every instruction it ran
+# and ret is where it returned to.
+MemoEntry = namedtuple(
+    'MemoEntry', ['reads', 'writes', 'code', 'ret', 'steps'])
+
+
+class _TraceFailed(Exception):
+    def __init__(self, is_impure):
+        super().__init__()
+        self.is_impure = is_impure
+
+
+class Memoizer:
+    """Skips subroutine calls whose results are already known.
+
+    Attach one with `machine.memo = Memoizer(find_calls(machine.memory))`.
+    The first call of a subroutine runs for real while every cell it reads
+    before writing is recorded, relative to the caller's relative base for
+    relative parameters and by address otherwise. A subroutine is pure if
+    it returns without any I/O, halting or writing to its own code; other
+    subroutines are rejected and always run normally. The result of a pure
+    call (everything it wrote, and where it returned to) is kept in an LRU
+    keyed by the values of all the cells the subroutine has been seen to
+    read, usually its arguments and return address. A later call with the
+    same values writes the same results without running.
+
+    Results are forgotten when the code they ran is overwritten.
+    """
+
+    def __init__(self, calls, maxsize=MEMO_SIZE):
+        self.calls = dict(calls)  # subroutine -> return addresses
+        self.maxsize = maxsize
+        self.signatures = {}  # subroutine -> cells read, ((relative, n))
+        self.results = OrderedDict()  # (subroutine, values) -> MemoEntry
+        self.code = {}  # instruction address -> subroutines which ran it
+        self.rejected = set()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.steps_saved = 0
+        self.cost = 0  # steps taken by call()
+
+    def copy(self):
+        memo = copy.copy(self)
+        memo.calls = dict(self.calls)
+        memo.signatures = dict(self.signatures)
+        memo.results = OrderedDict(self.results)
+        memo.code = {addr: set(s) for addr, s in self.code.items()}
+        memo.rejected = set(self.rejected)
+        return memo
+
+    def clear(self):
+        """Forget every result."""
+        self.signatures.clear()
+        self.results.clear()
+        self.code.clear()
+
+    def forget(self, addr):
+        """Forget results from subroutines which ran the instruction at
+        addr."""
+        for subroutine in self.code.pop(addr, ()):
+            self.signatures.pop(subroutine, None)
+            self.forget_results(subroutine)
+
+    def forget_results(self, subroutine):
+        for key in [k for k in self.results if k[0] == subroutine]:
+            del self.results[key]
+
+    def reject(self, subroutine):
+        """Never memoize subroutine again, dropping what it's stored."""
+        self.calls.pop(subroutine, None)
+        self.signatures.pop(subroutine, None)
+        self.forget_results(subroutine)
+        self.rejected.add(subroutine)
+
+    def call(self, vm, budget=float('inf')):
+        """Run the subroutine call at vm.instruction_ptr from a stored result
+        if there is one, otherwise for real.
+
+        Returns the number of steps that took (0 if this isn't a call to a
+        pure subroutine), at most budget. Each instruction run is a step, and
+        so is each call skipped using a stored result. If a call doesn't
+        return within the budget, the machine is left part way through it."""
+        cost = self.cost
+        try:
+            self._call(vm, cost + budget, 0)
+        except _TraceFailed:
+            pass
+        return self.cost - cost
+
+    def _call(self, vm, deadline, depth):
+        subroutine = vm.instruction_ptr
+        m = vm.memory
+        rb = vm.relative_base
+        rets = self.calls.get(subroutine)
+        if not rets or m[rb] not in rets:
+            return None
+        signature = self.signatures.get(subroutine, ())
+        values = tuple(m[rb + n] if rel else m[n] for rel, n in signature)
+        entry = self.results.get((subroutine, values))
+        if entry is not None:
+            self.cost += 1
+            self.results.move_to_end((subroutine, values))
+            self.hits += 1
+            self.steps_saved += entry.steps
+            for (rel, n), value in entry.writes:
+                addr = rb + n if rel else n
+                m[addr] = value
+                if addr in vm.code:
+                    vm.invalidate_code(addr)
+            vm.instruction_ptr = entry.ret
+            return entry
+
+        self.misses += 1
+        try:
+            entry = self._trace(vm, m[rb], deadline, depth)
+        except _TraceFailed as e:
+            if e.is_impure:
+                self.reject(subroutine)
+            raise
+        if self.signatures.get(subroutine, ()) != signature:
+            return entry  # forgotten while tracing
+        new = [cell for cell, _ in entry.reads if cell not in signature]
+        if new:
+            self.forget_results(subroutine)
+            reads = dict(entry.reads)
+            signature = self.signatures[subroutine] = signature + tuple(new)
+            values += tuple(reads[cell] for cell in new)
+        self.results[(subroutine, values)] = entry
+        while len(self.results) > self.maxsize:
+            self.results.popitem(last=False)
+            self.evictions += 1
+        for start, end in entry.code:
+            vm.add_code('memos', start, end)
+            self.code.setdefault(start, set()).add(subroutine)
+        return entry
+
+    def _trace(self, vm, ret, deadline, depth):
+        """Run a call for real, recording what it reads and writes."""
+        m = vm.memory
+        rb0 = vm.relative_base
+        reads = {}  # cell -> value before the call
+        written = {}  # address -> cell
+        code = set()
+        fetched = set()  # addresses of code cells
+        steps = 0  # including those of nested calls
+        executed = 0
+        while True:
+            ip = vm.instruction_ptr
+            rb = vm.relative_base
+            if steps and ip == ret and rb == rb0:
+                break
+            if self.cost >= deadline:
+                raise _TraceFailed(is_impure=False)
+            if executed >= MEMO_TRACE_STEPS:
+                raise _TraceFailed(is_impure=True)
+
+            if steps and ip in self.calls and depth < MEMO_MAX_DEPTH:
+                entry = self._call(vm, deadline, depth + 1)
+                if entry is not None:
+                    for (rel, n), value in entry.reads:
+                        addr = rb + n if rel else n
+                        if addr not in written:
+                            cell = (True, addr - rb0) if rel else (False, n)
+                            reads.setdefault(cell, value)
+                    for (rel, n), _ in entry.writes:
+                        addr = rb + n if rel else n
+                        if addr in fetched:
+                            raise _TraceFailed(is_impure=True)
+                        written.setdefault(
+                            addr, (True, addr - rb0) if rel else (False, n))
+                    code |= entry.code
+                    for start, end in entry.code:
+                        fetched.update(range(start, end))
+                    steps += entry.steps
+                    continue
+
+            opcode = m[ip] % 100
+            if opcode not in NUM_PARAMS or opcode in (INPUT, OUTPUT, STOP):
+                raise _TraceFailed(is_impure=True)
+            opcode, modes = decode_instruction(m[ip])
+            length = 1 + len(modes)
+            if any(addr in written for addr in range(ip, ip + length)):
+                raise _TraceFailed(is_impure=True)  # self-modifying
+            code.add((ip, ip + length))
+            fetched.update(range(ip, ip + length))
+            params = [m[ip + i] for i in range(1, length)]
+
+            vals = []
+            for v, mode in zip(params, modes[:2]):
+                if mode == MODE_IMM:
+                    vals.append(v)
+                    continue
+                addr = rb + v if mode == MODE_REL else v
+                value = m[addr]
+                if addr not in written:
+                    cell = (
+                        (True, addr - rb0) if mode == MODE_REL
+                        else (False, addr)
+                    )
+                    reads.setdefault(cell, value)
+                vals.append(value)
+
+            next_ip = ip + length
+            if opcode == JUMP_IF_TRUE:
+                if vals[0] != 0:
+                    next_ip = vals[1]
+            elif opcode == JUMP_IF_FALSE:
+                if vals[0] == 0:
+                    next_ip = vals[1]
+            elif opcode == ADJUST_RELATIVE_BASE:
+                vm.relative_base += vals[0]
+            else:
+                a, b = vals
+                if opcode == ADD:
+                    value = a + b
+                elif opcode == MULTIPLY:
+                    value = a * b
+                elif opcode == LESS_THAN:
+                    value = 1 if a < b else 0
+                else:
+                    value = 1 if a == b else 0
+                if modes[2] == MODE_REL:
+                    addr = rb + params[2]
+                    cell = (True, addr - rb0)
+                elif modes[2] == MODE_POS:
+                    addr = params[2]
+                    cell = (False, addr)
+                else:
+                    raise ValueError(f'Invalid mode for write: {modes[2]}')
+                if addr in fetched:
+                    raise _TraceFailed(is_impure=True)  # self-modifying
+                m[addr] = value
+                written.setdefault(addr, cell)
+                if addr in vm.code:
+                    vm.invalidate_code(addr)
+            vm.instruction_ptr = next_ip
+            steps += 1
+            executed += 1
+            self.cost += 1
+
+        return MemoEntry(
+            reads=tuple(reads.items()),
+            writes=tuple(
+                (cell, m[addr]) for addr, cell in written.items()),
+            code=frozenset(code),
+            ret=ret,
+            steps=steps,
+        )
+
+    def to_json(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': self.hits / ((self.hits + self.misses) or 1),
+            'evictions': self.evictions,
+            'steps_saved': self.steps_saved,
+            'results': len(self.results),
+            'subroutines': sorted(set(self.signatures) - self.rejected),
+            'rejected': sorted(self.rejected),
+        }
+
+
+Snapshot = namedtuple('Snapshot', [
+    'memory', 'instruction_ptr', 'relative_base', 'is_halted',
+    'inputs', 'outputs', 'code', 'templates',
+])
+
+
+# Most compiled block factories kept. Self-modifying code can make new
+# block sources without end.
+BLOCK_FACTORIES_SIZE = 4096
+_block_factories = OrderedDict()  # source -> factory
+
+
+def block_factory(src):
+    """Compile (once per distinct source) a block_source() factory."""
+    factory = _block_factories.get(src)
+    if factory is not None:
+        _block_factories.move_to_end(src)
+        return factory
+    namespace = dict(_CODEGEN_GLOBALS)
+    exec(src, namespace)
+    factory = _block_factories[src] = namespace['factory']
+    if len(_block_factories) > BLOCK_FACTORIES_SIZE:
+        _block_factories.popitem(last=False)
+    return factory
+
+
+# Bump this whenever block_source() changes, so stale modules are rebuilt.
+AOT_VERSION = 2
+# Where load_aot() caches modules. This is per user: the modules get run.
+AOT_CACHE_DIR = os.environ.get('INTCODE_AOT_CACHE') or os.path.join(
+    os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'),
+    'intcode-aot')
+_WRITES = {ADD: 2, MULTIPLY: 2, LESS_THAN: 2, EQUALS: 2, INPUT: 0}
+
+
+def _block_instructions(m, start, end):
+    """(address, opcode, modes, params) for each instruction in a block."""
+    ip = start
+    while ip < end:
+        opcode, modes = decode_instruction(m[ip])
+        yield ip, opcode, modes, [m[ip + i] for i in range(1, len(modes) + 1)]
+        ip += 1 + len(modes)
+
+
+def find_blocks(m):
+    """Statically find the basic blocks of the program in m.
+
+    Follows control flow from address 0 through every jump with an
+    immediate target. The address after an unconditional jump is only
+    taken to be code if some instruction has it as an immediate (i.e. it's
+    a return address). Jumps to computed addresses aren't followed; those
+    blocks get compiled when they're reached.
+
+    Programs commonly patch the parameters of their own instructions
+    (e.g. pointers and jump targets), and rarely the opcodes. Returns
+    {start: end} for each block and the set of parameters (not opcodes)
+    which some instruction writes to directly.
+    """
+    blocks = {}
+    immediates = set()
+    pending = set()  # addresses after unconditional jumps
+    todo = [0]
+    while todo:
+        start = todo.pop()
+        if start in blocks:
+            continue
+        try:
+            _, end = block_source(m, start)
+        except ValueError:
+            continue  # not code after all
+        blocks[start] = end
+        for ip, opcode, modes, params in _block_instructions(m, start, end):
+            for param, mode in zip(params, modes):
+                if mode == MODE_IMM and param not in immediates:
+                    immediates.add(param)
+                    if param in pending:
+                        todo.append(param)
+        if opcode == STOP:
+            continue
+        if opcode not in (JUMP_IF_TRUE, JUMP_IF_FALSE):
+            todo.append(end)
+            continue
+        taken = None
+        if modes[0] == MODE_IMM:
+            taken = (params[0] != 0) == (opcode == JUMP_IF_TRUE)
+        if taken is not False and modes[1] == MODE_IMM:
+            todo.append(params[1])
+        if taken is not True or end in immediates:
+            todo.append(end)
+        else:
+            pending.add(end)
+
+    instructions = [
+        instruction
+        for start, end in blocks.items()
+        for instruction in _block_instructions(m, start, end)
+    ]
+    opcodes = {ip for ip, _, _, _ in instructions}
+    code = set()
+    for start, end in blocks.items():
+        code.update(range(start, end))
+    dynamic = set()
+    for ip, opcode, modes, params in instructions:
+        i = _WRITES.get(opcode)
+        if i is not None and modes[i] == MODE_POS:
+            if params[i] in code and params[i] not in opcodes:
+                dynamic.add(params[i])
+    return blocks, dynamic
+
+
+def aot_source(m):
+    """Python source for a module with every block find_blocks() finds.
+
+    BLOCKS maps each block's start to its factory and end address, and
+    DYNAMIC is the set of parameters which are read when the blocks run."""
+    lines = ['# Ahead-of-time compiled Intcode program, from intcode.py.']
+    lines += [
+        f'{name} = {value!r}' for name, value in _CODEGEN_GLOBALS.items()
+    ]
+    blocks, dynamic = find_blocks(m)
+    lines.append(f'DYNAMIC = {sorted(dynamic)}')
+    for start in sorted(blocks):
+        src, _ = block_source(m, start, dynamic=dynamic)
+        src = src.replace('def factory(', f'def block_{start}(', 1)
+        lines += ['', '', src]
+    lines += ['', '', 'BLOCKS = {']
+    lines += [
+        f'    {start}: (block_{start}, {end}),'
+        for start, end in sorted(blocks.items())
+    ]
+    return '\n'.join(lines + ['}', ''])
+
+
+_aot_modules = {}
+
+
+def _check_private(path):
+    """Raise ValueError unless path is owned by this user and nobody else
+    can write to it."""
+    st = os.stat(path)
+    if st.st_uid != os.getuid() or st.st_mode & 0o022:
+        raise ValueError(f'Not loading from {path}: it is not private')
+
+
+def load_aot(memory, cache_dir=None):
+    """The ahead-of-time compiled module for the program in a PagedMemory.
+
+    Modules are cached on disk (in AOT_CACHE_DIR by default) keyed by the
+    program's sha256, so later processes just import them, bytecode and
+    all. Raises ValueError rather than import anything from a directory or
+    file which isn't ours, or which others can write to."""
+    digest = hashlib.sha256(str(AOT_VERSION).encode())
+    for n, page in sorted(memory.pages.items()):
+        digest.update(array('q', [n]))
+        digest.update(page)
+    digest.update(repr(sorted(memory.big.items())).encode())
+    name = f'intcode_aot_{digest.hexdigest()[:32]}'
+    module = _aot_modules.get(name)
+    if module is None:
+        cache_dir = cache_dir or AOT_CACHE_DIR
+        path = os.path.join(cache_dir, name + '.py')
+        os.makedirs(cache_dir, mode=0o700, exist_ok=True)
+        _check_private(cache_dir)
+        if not os.path.exists(path):
+            _write_atomically(path, [aot_source(memory).encode()])
+        _check_private(path)
+        spec = importlib.util.spec_from_file_location(name, path)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        _aot_modules[name] = module
+    return module
+
+
+# Most instructions prove_idle() will run looking for the end of a poll loop.
+IDLE_PROOF_STEPS = 10_000
+# Polls to let through normally after a failed proof before trying again.
+IDLE_BACKOFF = 16
+
+
 class IntCode:
-    def __init__(self, memory, inputs=None):
-        self.memory = defaultdict(int)
-        self.memory.update(enumerate(memory))
+    """An Intcode machine.
+
+    Solvers attach devices by subclassing and overriding the I/O hooks:
+    pop_input() (and has_input(), for run_until_blocked()) to supply
+    input, and output() to consume it. The engine (a class attribute or
+    constructor argument) picks how instructions are executed; every
+    engine calls the same hooks.
+    """
+
+    engine = ENGINE_INTERPRET
+    profiler = None
+    memo = None  # Memoizer
+    # What pop_input() returns when there's no input (e.g. -1 for day 23).
+    # Setting this also turns on fast-forwarding of idle poll loops.
+    idle_input = None
+
+    def __init__(self, memory, inputs=None, engine=None):
+        self.memory = PagedMemory(memory)
         self.instruction_ptr = 0
-        self.inputs = inputs or []
-        self.outputs = []
+        self.inputs = inputs or ()
+        self.outputs = ()
         self.is_halted = False
         self.relative_base = 0
+        if engine:
+            self.engine = engine
+        self.blocking = False  # True inside run_until_blocked()
+        self.last_run_steps = 0  # instructions the last of those ran
+        self.run_status = None  # why run() last stopped
+        self.journal = None  # address -> old value while proving idleness
+        # (path, id, {page number: page}) as of the last checkpoint
+        self.last_checkpoint = None
+        self.is_idle_proven = False
+        self.idle_loop_steps = 0  # length of the last proven idle loop
+        self.idle_polls_skipped = 0
+        self.idle_backoff = 0
+        self.decoded = {}  # address -> handler for one instruction
+        # address -> handler for a superinstruction (or one instruction)
+        self.fused = {}
+        self.fusion_counts = Counter()  # fusion name -> times run
+        self.blocks = {}  # address -> compiled basic block
+        # (table, address) -> (factory, args) to (re)build a decoded entry.
+        # These don't refer to the machine, so forks can share them.
+        self.templates = {}
+        # address -> frozenset({(table, start, end)}) for code which reads it
+        self.code = {}
+        self.aot = None  # the ahead-of-time compiled module, if any
+        if self.engine == ENGINE_AOT:
+            self.use_aot()
+
+    @property
+    def inputs(self):
+        """Input Channel. Assigning a Channel shares it; anything else is
+        copied into a new one."""
+        return self._inputs
+
+    @inputs.setter
+    def inputs(self, values):
+        self._inputs = (
+            values if isinstance(values, Channel) else Channel(values)
+        )
+
+    @property
+    def outputs(self):
+        """Output Channel, with the same assignment rules as inputs."""
+        return self._outputs
+
+    @outputs.setter
+    def outputs(self, values):
+        self._outputs = (
+            values if isinstance(values, Channel) else Channel(values)
+        )
 
     def pop_input(self):
-        v, *rest = self.inputs
-        self.inputs = rest
-        return v
+        if not self._inputs and self.idle_input is not None:
+            return self.idle_input
+        return self._inputs.pop()
+
+    def has_input(self):
+        """Whether an INPUT instruction can run without blocking.
+
+        Subclasses which generate their own inputs in pop_input() should
+        override this too if they want to use run_until_blocked()."""
+        return bool(self.inputs)
+
+    def can_output(self):
+        """Whether an OUTPUT instruction can run without blocking."""
+        return not self._outputs.is_full
 
     def output(self, value):
-        self.outputs.append(value)
+        self._outputs.push(value)
 
     def decode_param(self, v, mode):
         if mode == MODE_IMM:
@@ -75,33 +1565,80 @@ class IntCode:
 
     def write_memory(self, parameter, mode, value):
         if mode == MODE_POS:
-            self.memory[parameter] = value
+            addr = parameter
         elif mode == MODE_REL:
-            self.memory[self.relative_base + parameter] = value
+            addr = self.relative_base + parameter
         else:
             raise ValueError(f'Invalid mode for write: {mode}')
+        if self.journal is not None and addr not in self.journal:
+            self.journal[addr] = self.memory[addr]
+        self.memory[addr] = value
+        if addr in self.code:
+            self.invalidate_code(addr)
 
     def run_one_instruction(self):
+        if self.profiler:
+            self.run_profiled_instruction()
+        elif self.engine != ENGINE_INTERPRET:
+            self.run_cached_instruction()
+        else:
+            self.interpret_one_instruction()
+
+    def interpret_one_instruction(self):
         m = self.memory
-        instruction = m[self.instruction_ptr]
-        opcode, modes = decode_instruction(instruction)
+        pages = m.pages
+        ip = self.instruction_ptr
+        # Fast path: the whole instruction is on one page, read in one go.
+        page = pages.get(ip >> PAGE_BITS)
+        i = ip & PAGE_MASK
+        cells = None
+        if page is not None and i <= PAGE_SIZE - MAX_INSTRUCTION_LENGTH:
+            cells = page[i:i + MAX_INSTRUCTION_LENGTH].tolist()
+            if OVERFLOW in cells:
+                cells = None
+        instruction = m[ip] if cells is None else cells[0]
+        decoded = _decoded_instructions.get(instruction)
+        if decoded is None:
+            decoded = decode_instruction(instruction)
+            _decoded_instructions[instruction] = decoded
+        opcode, modes = decoded
 
         if opcode == STOP:
             self.is_halted = True
             return
 
+        if opcode == INPUT and self.journal is None:
+            if (
+                self.idle_input is not None and
+                not self.has_input() and
+                self.poll_idle()
+            ):
+                return
+            self.is_idle_proven = False
+
         num_params = len(modes)
-        parameters = [
-            m[self.instruction_ptr + i]
-            for i in range(1, 1 + num_params)
-        ]
+        if cells is None:
+            parameters = [m[ip + i] for i in range(1, 1 + num_params)]
+        else:
+            parameters = cells[1:1 + num_params]
 
-        vals = [
-            self.decode_param(v, mode)
-            for v, mode in zip(parameters, modes)
-        ]
+        vals = []
+        for v, mode in zip(parameters, modes):
+            if mode == MODE_IMM:
+                vals.append(v)
+                continue
+            if mode == MODE_REL:
+                v += self.relative_base
+            elif mode != MODE_POS:
+                raise ValueError(f'Invalid mode {mode}')
+            page = pages.get(v >> PAGE_BITS)
+            if page is None:
+                vals.append(0)
+                continue
+            value = page[v & PAGE_MASK]
+            vals.append(m.big[v] if value == OVERFLOW else value)
 
-        self.instruction_ptr += 1 + len(parameters)
+        self.instruction_ptr = ip + 1 + num_params
 
         if opcode == ADD:
             self.write_memory(parameters[2], modes[2], vals[0] + vals[1])
@@ -111,7 +1648,10 @@ class IntCode:
             val = self.pop_input()
             self.write_memory(parameters[0], modes[0], val)
         elif opcode == OUTPUT:
+            # Stay on the OUTPUT if it raises, so it can be run again.
+            self.instruction_ptr = ip
             self.output(vals[0])
+            self.instruction_ptr = ip + 2
         elif opcode == JUMP_IF_TRUE:
             if vals[0] != 0:
                 self.instruction_ptr = vals[1]
@@ -133,24 +1673,1395 @@ class IntCode:
         else:
             raise ValueError(f'Invalid opcode: {opcode}')
 
-    def run(self):
-        """Run to halt. Returns outputs."""
+    def prove_idle(self, max_steps=IDLE_PROOF_STEPS, iterations=2):
+        """Run a poll loop and check whether it is idle.
+
+        Call this at an INPUT with no input available. It really executes
+        instructions (reading idle_input) up to the next INPUT, OUTPUT or
+        halt. Returns True if that is this same INPUT, still without input,
+        with the same relative base and the same memory: nothing was output,
+        so the loop can only repeat exactly until input arrives and running
+        it any further would be unobservable. The first pass through a loop
+        often stores idle_input somewhere, so this tries a few iterations.
+        Once proven, polls are skipped (see poll_idle()) until input arrives.
+        """
+        for _ in range(iterations):
+            ip, relative_base = self.instruction_ptr, self.relative_base
+            self.journal = journal = {}
+            try:
+                for steps in range(max_steps):
+                    opcode = self.memory[self.instruction_ptr] % 100
+                    if steps and opcode in (INPUT, OUTPUT, STOP):
+                        break
+                    self.interpret_one_instruction()
+                else:
+                    return False
+            finally:
+                self.journal = None
+
+            if (
+                opcode != INPUT or
+                self.instruction_ptr != ip or
+                self.relative_base != relative_base or
+                self.has_input()
+            ):
+                return False
+            if all(self.memory[addr] == old for addr, old in journal.items()):
+                self.idle_loop_steps = steps
+                self.is_idle_proven = True
+                return True
+        return False
+
+    def poll_idle(self):
+        """Handle an INPUT with no input available outside of
+        run_until_blocked().
+
+        Returns True if the INPUT shouldn't run: either the program is
+        already proven to be spinning idle (so the poll is skipped) or
+        prove_idle() just ran an iteration of the loop."""
+        if self.is_idle_proven:
+            self.idle_polls_skipped += 1
+            return True
+        if self.idle_backoff:
+            self.idle_backoff -= 1
+            return False
+        if not self.prove_idle():
+            self.idle_backoff = IDLE_BACKOFF
+        return True
+
+    def decode_at(self, addr):
+        """Decode the instruction at addr into a cached handler."""
+        template = self.templates.get(('decoded', addr))
+        if template is None:
+            template, end = self.handler_template(addr)
+            self.templates[('decoded', addr)] = template
+            self.add_code('decoded', addr, end)
+        factory, args = template
+        op = self.decoded[addr] = factory(self, self.memory, self.code, *args)
+        return op
+
+    def handler_template(self, addr):
+        m = self.memory
+        if m[addr] % 100 not in NUM_PARAMS:
+            raise ValueError(f'Invalid opcode: {m[addr] % 100}')
+        opcode, modes = decode_instruction(m[addr])
+        length = 1 + len(modes)
+        parameters = [m[addr + i] for i in range(1, length)]
+        template = (
+            handler_factory(opcode, modes),
+            (addr, *parameters, addr + length)
+        )
+        return template, addr + length
+
+    def fuse_at(self, addr):
+        """Decode the instructions at addr into a cached handler, fused into
+        a superinstruction if they match one of FUSIONS."""
+        template = self.templates.get(('fused', addr))
+        if template is None:
+            fusion = find_fusion(self.memory, addr)
+            if fusion is None:
+                template, end = self.handler_template(addr)
+            else:
+                name, instructions = fusion
+                shapes = tuple(
+                    (opcode, tuple(modes))
+                    for opcode, modes, _, _ in instructions
+                )
+                args = [addr]
+                for _, _, params, next_ip in instructions:
+                    args += params + [next_ip]
+                template = (fusion_factory(name, shapes), tuple(args))
+                end = instructions[-1][-1]
+            self.templates[('fused', addr)] = template
+            self.add_code('fused', addr, end)
+        factory, args = template
+        op = self.fused[addr] = factory(self, self.memory, self.code, *args)
+        return op
+
+    def fusion_report(self):
+        """{fusion name: {'fired': count, 'steps_saved': dispatches saved}}
+        for each fusion that has run."""
+        return {
+            name: {
+                'fired': count,
+                'steps_saved': count * (FUSION_LENGTHS[name] - 1),
+            }
+            for name, count in self.fusion_counts.most_common()
+        }
+
+    def compile_block(self, addr):
+        """Compile the basic block starting at addr.
+
+        With AOT, the program's dynamic parameters are read when the block
+        runs, as in the precompiled blocks, so writing them is free."""
+        template = self.templates.get(('blocks', addr))
+        if template is None:
+            m = self.memory
+            dynamic = set(self.aot.DYNAMIC) if self.aot else ()
+            src, end = block_source(m, addr, dynamic=dynamic)
+            template = (block_factory(src), ())
+            self.templates[('blocks', addr)] = template
+            skip = ()
+            if dynamic:
+                # Only parameters are read live; opcodes are still baked in.
+                skip = dynamic & {
+                    ip + i
+                    for ip, _, modes, _ in _block_instructions(m, addr, end)
+                    for i in range(1, len(modes) + 1)
+                }
+            self.add_code('blocks', addr, end, skip=skip)
+        factory, args = template
+        block = self.blocks[addr] = factory(self, self.memory, self.code)
+        return block
+
+    def use_aot(self, cache_dir=None):
+        """Start with every block load_aot() finds compiled already.
+
+        Writes to the parameters the blocks read when they run are free.
+        Any other write to code (an opcode, or through the relative base)
+        throws away the blocks it hits as usual, so that they're compiled
+        again from what's in memory when they're next reached."""
+        self.aot = load_aot(self.memory, cache_dir)
+        dynamic = set(self.aot.DYNAMIC)
+        for start, (factory, end) in self.aot.BLOCKS.items():
+            self.templates[('blocks', start)] = (factory, ())
+            self.add_code('blocks', start, end, skip=dynamic)
+
+    def add_code(self, table, start, end, skip=()):
+        """Note that cells start to end, apart from those in skip, are read
+        by an entry in one of the code tables."""
+        entry = (table, start, end)
+        for cell in range(start, end):
+            if cell not in skip:
+                self.code[cell] = self.code.get(cell, frozenset()) | {entry}
+
+    def invalidate_code(self, addr):
+        """Forget every decoded instruction, block or memoized subroutine
+        result which reads addr."""
+        for entry in self.code.pop(addr, ()):
+            table, start, end = entry
+            if table == 'memos':
+                if self.memo:
+                    self.memo.forget(start)
+            else:
+                del self.templates[(table, start)]
+                getattr(self, table).pop(start, None)
+            for cell in range(start, end):
+                entries = self.code.get(cell)
+                if entries:
+                    entries = entries - {entry}
+                    if entries:
+                        self.code[cell] = entries
+                    else:
+                        del self.code[cell]
+
+    def fork(self):
+        """A copy of this machine which shares memory copy-on-write.
+
+        The copy starts with its own copies of the I/O channels and shares
+        the decoded code, so it runs at full speed straight away. Subclasses
+        with mutable state of their own should extend this to copy it."""
+        child = copy.copy(self)
+        child.memory = self.memory.fork()
+        child._inputs = Channel(self._inputs, self._inputs.capacity)
+        child._outputs = Channel(self._outputs, self._outputs.capacity)
+        child.decoded = {}
+        child.fused = {}
+        child.fusion_counts = Counter()
+        child.blocks = {}
+        child.code = dict(self.code)
+        child.templates = dict(self.templates)
+        child.journal = None
+        if self.memo:
+            child.memo = self.memo.copy()
+        return child
+
+    def snapshot(self):
+        """Cheaply capture the machine's state for restore()."""
+        return Snapshot(
+            memory=self.memory.fork(),
+            instruction_ptr=self.instruction_ptr,
+            relative_base=self.relative_base,
+            is_halted=self.is_halted,
+            inputs=list(self._inputs),
+            outputs=list(self._outputs),
+            code=dict(self.code),
+            templates=dict(self.templates),
+        )
+
+    def restore(self, snapshot):
+        """Go back to the state in a snapshot (which can be reused).
+
+        The I/O channels are refilled in place so that they stay wired."""
+        self.memory = snapshot.memory.fork()
+        self.instruction_ptr = snapshot.instruction_ptr
+        self.relative_base = snapshot.relative_base
+        self.is_halted = snapshot.is_halted
+        self._reset(
+            snapshot.inputs, snapshot.outputs,
+            dict(snapshot.code), dict(snapshot.templates),
+        )
+
+    def _reset(self, inputs, outputs, code, templates):
+        """Refill the I/O channels and start over with the given decoded
+        code, after replacing the machine's memory."""
+        self._inputs.clear()
+        self._inputs.extend(inputs)
+        self._outputs.clear()
+        self._outputs.extend(outputs)
+        self.decoded = {}
+        self.fused = {}
+        self.blocks = {}
+        self.code = code
+        self.templates = templates
+        self.is_idle_proven = False
+        if self.memo:
+            self.memo.clear()
+
+    def checkpoint(self, path, incremental=False, extra=None):
+        """Atomically save the machine's state to a binary file.
+
+        A full checkpoint holds every memory page. An incremental one only
+        holds the pages written since this machine's previous checkpoint and
+        refers to that checkpoint's file, which must be kept: restoring
+        reads the whole chain. `extra` is any JSON-compatible state of a
+        subclass's, which load_checkpoint() returns. Returns the number of
+        pages written."""
+        pages = self.memory.freeze()
+        parent = None
+        written = pages
+        if incremental:
+            if self.last_checkpoint is None:
+                raise ValueError('No checkpoint to start from')
+            parent_path, parent_id, parent_pages = self.last_checkpoint
+            if os.path.abspath(parent_path) == os.path.abspath(path):
+                raise ValueError(f'{path} is the previous checkpoint')
+            parent = {
+                'path': os.path.relpath(
+                    parent_path, os.path.dirname(path) or '.'),
+                'id': parent_id,
+            }
+            written = {
+                n: page for n, page in pages.items()
+                if parent_pages.get(n) is not page
+            }
+        meta = {
+            'id': os.urandom(8).hex(),
+            'parent': parent,
+            'instruction_ptr': self.instruction_ptr,
+            'relative_base': self.relative_base,
+            'is_halted': self.is_halted,
+            'inputs': list(self._inputs),
+            'outputs': list(self._outputs),
+            'big': {
+                str(addr): value for addr, value in self.memory.big.items()
+            },
+            'extra': extra,
+        }
+        _write_checkpoint(path, meta, written)
+        self.last_checkpoint = (path, meta['id'], pages)
+        return len(written)
+
+    def load_checkpoint(self, path):
+        """Go back to the state saved by checkpoint(). Returns its extra
+        state."""
+        meta, pages = _read_checkpoint(path)
+        memory = PagedMemory()
+        memory.pages = pages
+        memory.big = {int(addr): value for addr, value in meta['big'].items()}
+        self.memory = memory
+        self.instruction_ptr = meta['instruction_ptr']
+        self.relative_base = meta['relative_base']
+        self.is_halted = meta['is_halted']
+        self._reset(meta['inputs'], meta['outputs'], {}, {})
+        self.last_checkpoint = (path, meta['id'], memory.freeze())
+        return meta['extra']
+
+    def run_cached_instruction(self):
+        ip = self.instruction_ptr
+        op = self.decoded.get(ip) or self.decode_at(ip)
+        op()
+
+    def run_fused_instruction(self):
+        """Run the instruction or superinstruction at instruction_ptr."""
+        ip = self.instruction_ptr
+        op = self.fused.get(ip) or self.fuse_at(ip)
+        op()
+
+    def run_profiled_instruction(self):
+        ip = self.instruction_ptr
+        instruction = self.memory[ip]
+        relative_base = self.relative_base
+        status = (self.decoded.get(ip) or self.decode_at(ip))()
+        if status not in (NEEDS_INPUT, OUTPUT_FULL):
+            self.profiler.record(
+                ip, instruction, relative_base, self.instruction_ptr)
+        return status
+
+    def run_compiled_block(self):
+        ip = self.instruction_ptr
+        block = self.blocks.get(ip) or self.compile_block(ip)
+        return block()
+
+    def step_function(self):
+        """The function which advances the machine for this engine.
+
+        This runs a single instruction, except for the cached engine which
+        may run a superinstruction and the compiled engine which runs a whole
+        basic block (stopping after any I/O). Profiled machines
+        always run a single instruction. With a memo, calls to memoized
+        subroutines are handled by it instead."""
+        if self.profiler:
+            return self.run_profiled_instruction
+        elif self.engine in (ENGINE_COMPILED, ENGINE_AOT):
+            step = self.run_compiled_block
+        elif self.engine == ENGINE_CACHED:
+            step = self.run_fused_instruction
+        elif self.engine == ENGINE_INTERPRET:
+            step = self.interpret_one_instruction
+        else:
+            raise ValueError(f'Invalid engine: {self.engine}')
+        memo = self.memo
+        if not memo:
+            return step
+
+        def memoized_step():
+            if self.instruction_ptr in memo.calls and memo.call(self):
+                return
+            step()
+        return memoized_step
+
+    def run_until_blocked(self, max_steps=None):
+        """Run until the machine can't make progress without its caller.
+
+        Returns a status rather than raising:
+          NEEDS_INPUT: the next instruction is an INPUT and has_input() is
+            False. Add some input and call this again.
+          HAS_OUTPUT: the last instruction produced an output.
+          OUTPUT_FULL: the next instruction is an OUTPUT and can_output()
+            is False. Make room (e.g. pop from a bounded outputs channel)
+            and call this again.
+          HALTED: the program has stopped.
+          BUDGET_EXHAUSTED: max_steps instructions ran without any of the
+            above happening.
+        This always uses the decode cache (or compiled blocks with the
+        compiled engine), whatever the engine is. The number of
+        instructions it ran (not counting a final STOP) is left in
+        last_run_steps.
+        """
+        self.last_run_steps = 0
+        if self.is_halted:
+            return HALTED
+        limit = float('inf') if max_steps is None else max_steps
+        self.blocking = True
+        try:
+            if self.profiler:
+                return self._run_profiled_until_blocked(limit)
+            elif self.engine in (ENGINE_COMPILED, ENGINE_AOT):
+                return self._run_blocks_until_blocked(limit)
+            return self._run_instructions_until_blocked(limit)
+        finally:
+            self.blocking = False
+
+    def _run_instructions_until_blocked(self, limit):
+        fused = self.fused
+        memo = self.memo
+        steps = 0
+        # Superinstructions can only overrun the budget after this.
+        safe = limit - max(FUSION_LENGTHS.values())
+        while steps < limit:
+            ip = self.instruction_ptr
+            if memo and ip in memo.calls:
+                n = memo.call(self, limit - steps)
+                if n:
+                    steps += n
+                    continue
+            op = fused.get(ip) or self.fuse_at(ip)
+            if steps > safe and steps + op.length > limit:
+                # Not enough budget left for the whole superinstruction.
+                op = self.decoded.get(ip) or self.decode_at(ip)
+            status = op()
+            if status:
+                if status.__class__ is int:
+                    # A superinstruction stopped early, after a code write.
+                    steps += status
+                    continue
+                if status == HAS_OUTPUT:
+                    steps += 1
+                self.last_run_steps += steps
+                return status
+            steps += op.length
+        self.last_run_steps += steps
+        return BUDGET_EXHAUSTED
+
+    def _run_profiled_until_blocked(self, limit):
+        steps = 0
+        while steps < limit:
+            status = self.run_profiled_instruction()
+            if status:
+                if status == HAS_OUTPUT:
+                    steps += 1
+                self.last_run_steps += steps
+                return status
+            steps += 1
+        self.last_run_steps += steps
+        return BUDGET_EXHAUSTED
+
+    def _run_blocks_until_blocked(self, limit):
+        blocks = self.blocks
+        memo = self.memo
+        steps = 0
+        # Blocks can only overrun the budget after this.
+        safe = limit - MAX_BLOCK_INSTRUCTIONS
+        while steps < limit:
+            ip = self.instruction_ptr
+            if memo and ip in memo.calls:
+                n = memo.call(self, limit - steps)
+                if n:
+                    steps += n
+                    continue
+            block = blocks.get(ip) or self.compile_block(ip)
+            if steps > safe and steps + block.length > limit:
+                # Not enough budget left for the whole block.
+                self.last_run_steps += steps
+                return self._run_instructions_until_blocked(limit - steps)
+            n = block()
+            if n == block.length and not block.exits:
+                steps += n
+                continue
+            status = None
+            if n < 0:
+                n = ~n
+                status = OUTPUT_FULL
+            elif self.is_halted:
+                n -= 1  # STOP doesn't count as a step
+                status = HALTED
+            elif n == 0:
+                status = NEEDS_INPUT
+            elif n == block.length and block.ends_with_output:
+                status = HAS_OUTPUT
+            steps += n
+            if status:
+                self.last_run_steps += steps
+                return status
+        self.last_run_steps += steps
+        return BUDGET_EXHAUSTED
+
+    def run(self, max_steps=None, deadline=None):
+        """Run to halt. Returns outputs.
+
+        With max_steps or a deadline (a time.monotonic() time), stop early
+        once that many instructions have run or the deadline has passed.
+        The deadline is checked every RUN_CHECK_STEPS instructions or so.
+        run_status says why it stopped, HALTED, BUDGET_EXHAUSTED or
+        DEADLINE_EXCEEDED, and calling run() again carries on from there.
+        A run with limits leaves the number of instructions it ran in
+        last_run_steps."""
+        if max_steps is not None or deadline is not None:
+            return self._run_limited(max_steps, deadline)
+        step = self.step_function()
         while not self.is_halted:
-            self.run_one_instruction()
+            step()
+
+        self.run_status = HALTED
+        return self.outputs
 
+    def _run_limited(self, max_steps, deadline):
+        steps = 0
+        status = HALTED
+        while not self.is_halted:
+            if max_steps is not None and steps >= max_steps:
+                status = BUDGET_EXHAUSTED
+                break
+            if deadline is not None and time.monotonic() >= deadline:
+                status = DEADLINE_EXCEEDED
+                break
+            chunk = RUN_CHECK_STEPS
+            if max_steps is not None:
+                chunk = min(chunk, max_steps - steps)
+            blocked = self.run_until_blocked(chunk) in (
+                NEEDS_INPUT, OUTPUT_FULL)
+            steps += self.last_run_steps
+            if blocked and steps != max_steps:
+                # Do it the way run() would, with pop_input() or output().
+                self.run_one_instruction()
+                steps += 1
+        self.last_run_steps = steps
+        self.run_status = status
         return self.outputs
 
     def run_to_output(self):
         """Run until the program outputs.
 
-        Returns that output or None if the program halts before output."""
-        self.outputs = []
+        Returns that output or None if the program halts before output.
+        This clears any earlier outputs."""
+        self.outputs.clear()
+        step = self.step_function()
         while not self.is_halted and not self.outputs:
-            self.run_one_instruction()
+            step()
 
         return self.outputs[0] if self.outputs else None
 
 
+def connect(source, dest):
+    """Feed source's outputs straight into dest's inputs.
+
+    Anything already waiting in dest's inputs (e.g. a phase setting) is read
+    before source's outputs."""
+    channel = Channel(dest.inputs.drain())
+    channel.extend(source.outputs.drain())
+    source.outputs = dest.inputs = channel
+    return channel
+
+
+DATAFLOW_BATCH_STEPS = 100_000
+
+
+class Dataflow:
+    """A network of named machines joined by edges.
+
+    Every value a node outputs is sent down each of its edges (fan-out),
+    and a node with several incoming edges reads their values in the order
+    they arrive (fan-in). Outputs of a node with no edges stay in its
+    outputs. Cycles are allowed, e.g. day 7's feedback ring.
+
+    run() only runs nodes with something to do: each of them once to
+    start with, then any node which was sent input. A node runs for up to
+    batch_size instructions at a time and its outputs are delivered in
+    bulk afterwards. counts holds how many values went down each edge.
+    """
+
+    def __init__(self, batch_size=DATAFLOW_BATCH_STEPS):
+        self.batch_size = batch_size
+        self.nodes = {}  # name -> machine
+        self.edges = {}  # name -> [destination names]
+        self.counts = Counter()  # (source, dest) -> values sent
+        self.steps = 0  # instructions run by every node
+        self.ready = deque()
+        self.is_ready = set()
+
+    def add_node(self, name, machine):
+        if name in self.nodes:
+            raise ValueError(f'Duplicate node {name!r}')
+        self.nodes[name] = machine
+        self.edges[name] = []
+        self._wake(name)
+        return machine
+
+    def add_edge(self, source, dest):
+        for name in (source, dest):
+            if name not in self.nodes:
+                raise ValueError(f'Unknown node {name!r}')
+        if dest in self.edges[source]:
+            raise ValueError(f'Duplicate edge {source!r} -> {dest!r}')
+        self.edges[source].append(dest)
+        self.counts[source, dest] = 0
+
+    def send(self, name, values):
+        """Add values to a node's inputs, so the next run() runs it."""
+        self.nodes[name].inputs.extend(values)
+        self._wake(name)
+
+    def _wake(self, name):
+        if name not in self.is_ready and not self.nodes[name].is_halted:
+            self.is_ready.add(name)
+            self.ready.append(name)
+
+    def run(self, max_steps=None):
+        """Run until no node can make progress.
+
+        Returns HALTED if every node has halted, NEEDS_INPUT if some are
+        waiting for input which nothing will send (send() some and call
+        this again to carry on), or BUDGET_EXHAUSTED
+        once max_steps instructions have run in total (call again to carry
+        on).
+        """
+        limit = float('inf') if max_steps is None else max_steps
+        steps = 0
+        while self.ready and steps < limit:
+            name = self.ready.popleft()
+            self.is_ready.discard(name)
+            machine = self.nodes[name]
+            budget = min(self.batch_size, limit - steps)
+            used = 0
+            status = HAS_OUTPUT
+            while status == HAS_OUTPUT and used < budget:
+                status = machine.run_until_blocked(budget - used)
+                used += machine.last_run_steps
+            steps += used
+            dests = self.edges[name]
+            if dests and machine.outputs:
+                values = machine.outputs.drain()
+                for dest in dests:
+                    self.nodes[dest].inputs.extend(values)
+                    self.counts[name, dest] += len(values)
+                    self._wake(dest)
+            if status in (HAS_OUTPUT, OUTPUT_FULL, BUDGET_EXHAUSTED):
+                self._wake(name)
+        self.steps += steps
+        if self.ready:
+            return BUDGET_EXHAUSTED
+        elif all(machine.is_halted for machine in self.nodes.values()):
+            return HALTED
+        return NEEDS_INPUT
+
+
+RECORD_INTERVAL = 100_000
+
+
+class Recording:
+    """A record of a machine's run which can be replayed from any point.
+
+    It holds every input the machine read and a snapshot every `interval`
+    instructions. Snapshots share unchanged pages copy-on-write, so each
+    one only holds copies of the pages written since the one before: they
+    are the per-interval write deltas.
+
+        recording = Recording(machine)
+        recording.run()  # like machine.run()
+        later = recording.seek(123_456)  # a fork after that many steps
+
+    Instruction counts are the ones run_until_blocked() uses. Machines with
+    a memo or idle_input skip instructions depending on state a snapshot
+    doesn't hold, so they can't be recorded.
+    """
+
+    def __init__(self, machine, interval=RECORD_INTERVAL):
+        if machine.memo or machine.idle_input is not None:
+            raise ValueError('Only machines without a memo or idle_input '
+                             'can be recorded')
+        self.machine = machine
+        self.is_loaded = False
+        self.interval = interval
+        self.count = 0  # instructions run so far
+        self.inputs = []  # every input the machine read, in order
+        # (count, inputs read, snapshot or checkpoint file), by count
+        self.checkpoints = []
+
+    def checkpoint(self):
+        snapshot = self.machine.snapshot()
+        self.checkpoints.append((self.count, len(self.inputs), snapshot))
+
+    def run(self, max_steps=None):
+        """Run the machine to halt (or for max_steps more instructions),
+        recording it. Returns its outputs."""
+        machine = self.machine
+        if self.is_loaded:
+            raise ValueError('A loaded recording can only be replayed')
+        if not self.checkpoints:
+            self.checkpoint()
+        pop_input = machine.pop_input
+
+        def record_input():
+            value = pop_input()
+            self.inputs.append(value)
+            return value
+        machine.pop_input = record_input
+        try:
+            self._run(max_steps)
+        finally:
+            del machine.pop_input
+        return machine.outputs
+
+    def _run(self, max_steps):
+        machine = self.machine
+        end = float('inf') if max_steps is None else self.count + max_steps
+        while not machine.is_halted and self.count < end:
+            next_checkpoint = self.checkpoints[-1][0] + self.interval
+            machine.run(max_steps=min(next_checkpoint, end) - self.count)
+            self.count += machine.last_run_steps
+            if self.count >= next_checkpoint:
+                self.checkpoint()
+
+    def seek(self, count):
+        """A fork of the machine as it was after `count` instructions (or
+        when it halted, if that was sooner).
+
+        This restores the last checkpoint at or before `count` and replays
+        the recorded inputs from there."""
+        if not 0 <= count <= self.count:
+            raise ValueError(f'Step {count} was not recorded')
+        i = bisect.bisect_right(
+            self.checkpoints, count, key=lambda checkpoint: checkpoint[0])
+        start, used, state = self.checkpoints[i - 1]
+        # Replay on a fork, leaving the recorded machine as it is.
+        machine = self.machine.fork()
+        self._restore(machine, state)
+        inputs = iter(self.inputs[used:])
+
+        def replay_input():
+            # Keep the input channel as it was while recording.
+            if machine.inputs:
+                machine.inputs.pop()
+            return next(inputs)
+        machine.pop_input = replay_input
+        machine.run(max_steps=count - start)
+        del machine.pop_input
+        return machine
+
+    def save(self, directory):
+        """Save the recording to a directory: a full checkpoint, then an
+        incremental one per interval and the inputs in recording.json."""
+        os.makedirs(directory, exist_ok=True)
+        machine = self.machine.fork()
+        files = []
+        for i, (count, used, state) in enumerate(self.checkpoints):
+            name = f'{i}.ckpt'
+            self._restore(machine, state)
+            machine.checkpoint(
+                os.path.join(directory, name), incremental=i > 0)
+            files.append([count, used, name])
+        meta = {
+            'interval': self.interval,
+            'count': self.count,
+            'inputs': self.inputs,
+            'checkpoints': files,
+        }
+        _write_atomically(
+            os.path.join(directory, 'recording.json'),
+            [json.dumps(meta).encode()])
+
+    @staticmethod
+    def _restore(machine, state):
+        if isinstance(state, str):
+            machine.load_checkpoint(state)
+        else:
+            machine.restore(state)
+
+    @classmethod
+    def load(cls, directory, machine):
+        """Load a saved recording of a run of machine's program to replay.
+
+        Replays are forks of machine, which isn't changed."""
+        with open(os.path.join(directory, 'recording.json')) as f:
+            meta = json.load(f)
+        recording = cls(machine, meta['interval'])
+        recording.is_loaded = True
+        recording.count = meta['count']
+        recording.inputs = meta['inputs']
+        recording.checkpoints = [
+            (count, used, os.path.join(directory, name))
+            for count, used, name in meta['checkpoints']
+        ]
+        return recording
+
+
+class BatchIntCode:
+    """Many copies of one program, stepped in lockstep with NumPy.
+
+    Each lane has its own row of memory, instruction pointer, relative base
+    and row of inputs. Every round, the running lanes are grouped by
+    (instruction pointer, instruction) and each group executes as a single
+    vectorised operation, so lanes whose control flow diverges are simply
+    regrouped. Arithmetic is 64-bit: a lane whose ADD or MULTIPLY would
+    overflow is handed over, just before it, to an IntCode machine in
+    `machines` (lane -> machine), which carries on with Python ints. Its
+    row of memory is left as it was then. A lane which hits an invalid
+    instruction or a negative address stops with the ValueError in
+    `errors` (lane -> error); the other lanes carry on.
+    """
+
+    def __init__(self, program, inputs_matrix, patches=None):
+        """patches maps an address to a value (or one value per lane) to
+        write into memory before running, e.g. day 2's noun and verb."""
+        inputs = np.asarray(inputs_matrix, dtype=np.int64)
+        n = len(inputs)
+        self.inputs = inputs.reshape(n, -1)
+        self.memory = np.tile(np.asarray(program, dtype=np.int64), (n, 1))
+        for addr, values in (patches or {}).items():
+            self.ensure_size(addr)
+            self.memory[:, addr] = values
+        self.input_ptr = np.zeros(n, dtype=np.int64)
+        self.instruction_ptr = np.zeros(n, dtype=np.int64)
+        self.relative_base = np.zeros(n, dtype=np.int64)
+        self.is_halted = np.zeros(n, dtype=bool)
+        self.is_blocked = np.zeros(n, dtype=bool)  # ran out of inputs
+        self.is_handed_off = np.zeros(n, dtype=bool)  # see machines
+        self.is_failed = np.zeros(n, dtype=bool)  # see errors
+        self.outputs = [[] for _ in range(n)]
+        self.machines = {}
+        self.errors = {}
+        self.handed_off_at = {}  # lane -> round of this run() it left at
+        self.round = 0
+
+    @property
+    def is_running(self):
+        return ~(
+            self.is_halted | self.is_blocked | self.is_handed_off |
+            self.is_failed)
+
+    def ensure_size(self, max_addr):
+        """Grow every lane's memory so that max_addr is addressable."""
+        size = self.memory.shape[1]
+        if max_addr < size:
+            return
+        grown = np.zeros(
+            (len(self.memory), max(2 * size, max_addr + 1)), dtype=np.int64)
+        grown[:, :size] = self.memory
+        self.memory = grown
+
+    def run(self, max_steps=None):
+        """Run every lane until it halts or runs out of inputs.
+
+        With max_steps, stop after that many rounds. Returns the outputs."""
+        self.round = 0
+        while max_steps is None or self.round < max_steps:
+            lanes = np.flatnonzero(self.is_running)
+            if not len(lanes):
+                break
+            ips = self.instruction_ptr[lanes]
+            if ips.min() < 0:
+                negative = ips < 0
+                self.fail(lanes[negative], ValueError(
+                    f'Negative instruction pointer: {ips.min()}'))
+                lanes, ips = lanes[~negative], ips[~negative]
+                if not len(lanes):
+                    continue
+            self.ensure_size(int(ips.max()) + MAX_INSTRUCTION_LENGTH)
+            words = self.memory[lanes, ips]
+            if (ips == ips[0]).all() and (words == words[0]).all():
+                self.execute(lanes, int(ips[0]), int(words[0]))
+            else:
+                keys, which = np.unique(
+                    np.stack([ips, words], axis=1), axis=0,
+                    return_inverse=True)
+                which = which.reshape(-1)
+                for i, (ip, word) in enumerate(keys):
+                    self.execute(lanes[which == i], int(ip), int(word))
+            self.round += 1
+        self.run_machines(max_steps)
+        return self.outputs
+
+    def hand_off(self, lanes):
+        """Carry on running lanes as IntCode machines."""
+        for lane in lanes.tolist():
+            machine = IntCode(
+                self.memory[lane].tolist(),
+                self.inputs[lane, self.input_ptr[lane]:].tolist())
+            machine.instruction_ptr = int(self.instruction_ptr[lane])
+            machine.relative_base = int(self.relative_base[lane])
+            self.machines[lane] = machine
+            self.handed_off_at[lane] = self.round
+            self.is_handed_off[lane] = True
+
+    def run_machines(self, max_steps):
+        """Run handed off lanes for the rest of this run()'s rounds."""
+        for lane, machine in self.machines.items():
+            start = self.handed_off_at.pop(lane, 0)
+            limit = None if max_steps is None else max_steps - start
+            status = HAS_OUTPUT
+            steps = 0
+            try:
+                while status == HAS_OUTPUT and (
+                        limit is None or steps < limit):
+                    status = machine.run_until_blocked(
+                        None if limit is None else limit - steps)
+                    steps += machine.last_run_steps
+            except ValueError as e:
+                self.fail([lane], e)
+            self.outputs[lane] += machine.outputs.drain()
+            self.is_halted[lane] = machine.is_halted
+            self.is_blocked[lane] = status == NEEDS_INPUT
+
+    def fail(self, lanes, error):
+        """Stop lanes for good, recording error for each."""
+        for lane in np.asarray(lanes).tolist():
+            self.errors[lane] = error
+            self.is_failed[lane] = True
+
+    def address(self, lanes, param, mode):
+        """Each lane's address for param; they may be negative."""
+        if mode == MODE_POS:
+            return param
+        elif mode == MODE_REL:
+            return self.relative_base[lanes] + param
+        raise ValueError(f'Invalid mode for address: {mode}')
+
+    def addresses(self, lanes, params, modes):
+        """(lanes, params, [each param's addresses, None if immediate]).
+
+        Lanes with a negative address fail and are left out. Memory is grown
+        to fit the rest."""
+        addrs = [
+            None if mode == MODE_IMM else self.address(lanes, p, mode)
+            for p, mode in zip(params, modes)
+        ]
+        used = [a for a in addrs if a is not None]
+        if not used or not len(lanes):
+            return lanes, params, addrs
+        negative = np.zeros(len(lanes), dtype=bool)
+        for a in used:
+            negative |= a < 0
+        if negative.any():
+            bad = np.stack(used)[:, negative].min()
+            self.fail(lanes[negative], ValueError(f'Negative address: {bad}'))
+            ok = ~negative
+            lanes, params = lanes[ok], [p[ok] for p in params]
+            addrs = [None if a is None else a[ok] for a in addrs]
+            used = [a for a in addrs if a is not None]
+            if not len(lanes):
+                return lanes, params, addrs
+        self.ensure_size(int(max(a.max() for a in used)))
+        return lanes, params, addrs
+
+    def execute(self, lanes, ip, instruction):
+        """Execute the instruction at ip for a group of lanes."""
+        try:
+            opcode, modes = decode_instruction(instruction)
+            writes = opcode in (ADD, MULTIPLY, LESS_THAN, EQUALS, INPUT)
+            if writes and modes[-1] == MODE_IMM:
+                raise ValueError(f'Invalid mode for address: {MODE_IMM}')
+        except ValueError as e:
+            self.fail(lanes, e)
+            return
+        if opcode == STOP:
+            self.is_halted[lanes] = True
+            return
+
+        m = self.memory
+        params = [m[lanes, ip + i] for i in range(1, 1 + len(modes))]
+        next_ip = ip + 1 + len(modes)
+
+        if opcode == INPUT:
+            pos = self.input_ptr[lanes]
+            has_input = pos < self.inputs.shape[1]
+            self.is_blocked[lanes[~has_input]] = True
+            lanes, _, (addrs,) = self.addresses(
+                lanes[has_input], [params[0][has_input]], modes)
+            pos = self.input_ptr[lanes]
+            self.memory[lanes, addrs] = self.inputs[lanes, pos]
+            self.input_ptr[lanes] += 1
+            self.instruction_ptr[lanes] = next_ip
+            return
+
+        lanes, params, addrs = self.addresses(lanes, params, modes)
+        if not len(lanes):
+            return
+        reads = len(modes) - 1 if writes else len(modes)
+        m = self.memory  # addresses() may have grown it
+        vals = [
+            p if addr is None else m[lanes, addr]
+            for p, addr in zip(params[:reads], addrs)
+        ]
+        if writes:
+            a, b = vals[0], vals[1]
+            if opcode in (ADD, MULTIPLY):
+                over = _overflows(opcode, a, b)
+                if over.any():
+                    self.hand_off(lanes[over])
+                    fits = ~over
+                    lanes, a, b = lanes[fits], a[fits], b[fits]
+                    addrs[2] = addrs[2][fits]
+            if opcode == ADD:
+                value = a + b
+            elif opcode == MULTIPLY:
+                value = a * b
+            elif opcode == LESS_THAN:
+                value = (a < b).astype(np.int64)
+            else:
+                value = (a == b).astype(np.int64)
+            self.memory[lanes, addrs[2]] = value
+            self.instruction_ptr[lanes] = next_ip
+        elif opcode == OUTPUT:
+            for lane, value in zip(lanes.tolist(), vals[0].tolist()):
+                self.outputs[lane].append(value)
+            self.instruction_ptr[lanes] = next_ip
+        elif opcode in (JUMP_IF_TRUE, JUMP_IF_FALSE):
+            jump = vals[0] != 0 if opcode == JUMP_IF_TRUE else vals[0] == 0
+            self.instruction_ptr[lanes] = np.where(jump, vals[1], next_ip)
+        elif opcode == ADJUST_RELATIVE_BASE:
+            self.relative_base[lanes] += vals[0]
+            self.instruction_ptr[lanes] = next_ip
+
+
+def _overflows(opcode, a, b):
+    """Which lanes' a + b (ADD) or a * b (MULTIPLY) don't fit in int64."""
+    if opcode == ADD:
+        total = a + b  # wraps
+        return ((a ^ total) & (b ^ total)) < 0
+    # Products that might be too big get checked exactly.
+    over = np.abs(a.astype(np.float64)) * np.abs(b.astype(np.float64)) >= (
+        2.0 ** 62)
+    for i in np.flatnonzero(over).tolist():
+        over[i] = not OVERFLOW <= int(a[i]) * int(b[i]) <= INT64_MAX
+    return over
+
+
+def run_batch(program, inputs_matrix, patches=None, max_steps=None):
+    """Run one program over each row of inputs_matrix in lockstep.
+
+    Returns a list with each lane's outputs. See BatchIntCode."""
+    batch = BatchIntCode(program, inputs_matrix, patches=patches)
+    return batch.run(max_steps=max_steps)
+
+
+class Linear:
+    """An affine function of named symbols: const + sum(coeff * symbol).
+
+    Arithmetic with ints and other Linears gives a Linear, or a plain int
+    once no symbols are left."""
+
+    def __init__(self, terms=(), const=0):
+        self.terms = {name: c for name, c in dict(terms).items() if c}
+        self.const = const
+
+    @classmethod
+    def symbol(cls, name):
+        return cls({name: 1})
+
+    @staticmethod
+    def make(terms, const):
+        """A Linear, or just const if all the coefficients are 0."""
+        linear = Linear(terms, const)
+        return linear if linear.terms else const
+
+    def __add__(self, other):
+        if not isinstance(other, Linear):
+            return Linear(self.terms, self.const + other)
+        terms = dict(self.terms)
+        for name, c in other.terms.items():
+            terms[name] = terms.get(name, 0) + c
+        return Linear.make(terms, self.const + other.const)
+
+    __radd__ = __add__
+
+    def __neg__(self):
+        return self * -1
+
+    def __sub__(self, other):
+        return self + -other
+
+    def __rsub__(self, other):
+        return -self + other
+
+    def __mul__(self, k):
+        if isinstance(k, Linear):
+            raise ValueError(f'({self}) * ({k}) is not linear')
+        return Linear.make(
+            {name: c * k for name, c in self.terms.items()}, self.const * k)
+
+    __rmul__ = __mul__
+
+    def __eq__(self, other):
+        return (
+            isinstance(other, Linear) and
+            (self.terms, self.const) == (other.terms, other.const)
+        )
+
+    def __hash__(self):
+        return hash((tuple(sorted(self.terms.items())), self.const))
+
+    def evaluate(self, values):
+        """The value for {symbol: value}. KeyError if one is missing."""
+        return self.const + sum(
+            c * values[name] for name, c in self.terms.items())
+
+    def __repr__(self):
+        parts = [
+            name if c == 1 else f'{c}*{name}'
+            for name, c in sorted(self.terms.items())
+        ]
+        if self.const:
+            parts.append(str(self.const))
+        return ' + '.join(parts).replace('+ -', '- ')
+
+
+class _Opaque:
+    def __repr__(self):
+        return 'OPAQUE'
+
+
+# What SymbolicIntCode reads from a symbolic address.
+OPAQUE = _Opaque()
+
+
+class SymbolicIntCode:
+    """Runs a program with some memory cells or inputs left as symbols.
+
+    Values are ints or Linear functions of the symbols, and stay linear
+    through ADD and MULTIPLY by a constant, so outputs (and memory) come
+    out as formulas. Where execution depends on a symbol's value (a branch,
+    comparison, address or product of two symbols), the machine falls back
+    to the concrete value given for it in `values` and adds what it
+    assumed to `constraints`, as (Linear, relation, 0) with relation one
+    of '==', '!=', '<' or '>='; the results hold whenever all of those do.
+    Without a value to fall back to it raises ValueError. Reading memory
+    at a symbolic address gives OPAQUE, which is only an error if the
+    program goes on to depend on it.
+    """
+
+    def __init__(self, memory, symbols=None, inputs=(), values=None):
+        """symbols maps addresses to the names of their symbols. Inputs can
+        be ints or Linears (e.g. Linear.symbol('x'))."""
+        self.memory = PagedMemory(memory)
+        self.cells = {  # address -> Linear or OPAQUE, over memory
+            addr: Linear.symbol(name)
+            for addr, name in (symbols or {}).items()
+        }
+        self.inputs = deque(inputs)
+        self.outputs = []
+        self.values = values or {}
+        self.constraints = []
+        self.instruction_ptr = 0
+        self.relative_base = 0
+        self.is_halted = False
+
+    def __getitem__(self, addr):
+        value = self.cells.get(addr)
+        return self.memory[addr] if value is None else value
+
+    def __setitem__(self, addr, value):
+        if isinstance(value, int):
+            self.cells.pop(addr, None)
+            self.memory[addr] = value
+        else:
+            self.cells[addr] = value
+
+    def concrete(self, value, what, relation='=='):
+        """value as an int, assuming the symbols have their concrete values
+        if it isn't one already."""
+        if value is OPAQUE:
+            raise ValueError(f'{what} depends on a symbolic address')
+        if isinstance(value, int):
+            return value
+        try:
+            result = value.evaluate(self.values)
+        except KeyError as e:
+            raise ValueError(f'{what} depends on {value}, and {e} has no '
+                             'value') from None
+        if relation == '==':
+            self.constraints.append((value - result, '==', 0))
+        elif relation == 'nonzero':
+            self.constraints.append((value, '!=' if result else '==', 0))
+        else:  # 'negative'
+            self.constraints.append((value, '<' if result < 0 else '>=', 0))
+        return result
+
+    def address(self, param, mode):
+        if mode == MODE_REL:
+            param = self.relative_base + param
+        elif mode != MODE_POS:
+            raise ValueError(f'Invalid mode for address: {mode}')
+        return param
+
+    def read(self, param, mode):
+        if mode == MODE_IMM:
+            return param
+        addr = self.address(param, mode)
+        if not isinstance(addr, int):
+            return OPAQUE
+        if addr < 0:
+            raise ValueError(f'Negative address: {addr}')
+        return self[addr]
+
+    def write(self, param, mode, value):
+        addr = self.concrete(self.address(param, mode), 'Write address')
+        if addr < 0:
+            raise ValueError(f'Negative address: {addr}')
+        self[addr] = value
+
+    def step(self):
+        ip = self.instruction_ptr
+        instruction = self[ip]
+        if not isinstance(instruction, int):
+            raise ValueError(f'Symbolic instruction at {ip}: {instruction}')
+        if instruction % 100 not in NUM_PARAMS:
+            raise ValueError(f'Invalid opcode: {instruction % 100}')
+        opcode, modes = decode_instruction(instruction)
+        params = [self[ip + i] for i in range(1, 1 + len(modes))]
+        next_ip = ip + 1 + len(modes)
+        if opcode == STOP:
+            self.is_halted = True
+            return
+        if opcode == INPUT:
+            if not self.inputs:
+                raise ValueError('No input')
+            self.write(params[0], modes[0], self.inputs.popleft())
+            self.instruction_ptr = next_ip
+            return
+
+        a = self.read(params[0], modes[0])
+        if opcode == OUTPUT:
+            if a is OPAQUE:
+                raise ValueError(f'Output at {ip} depends on a symbolic '
+                                 'address')
+            self.outputs.append(a)
+        elif opcode == ADJUST_RELATIVE_BASE:
+            self.relative_base += self.concrete(a, 'Relative base')
+        elif opcode in (JUMP_IF_TRUE, JUMP_IF_FALSE):
+            jump = self.concrete(a, f'Branch at {ip}', 'nonzero') != 0
+            if jump == (opcode == JUMP_IF_TRUE):
+                next_ip = self.concrete(
+                    self.read(params[1], modes[1]), f'Jump target at {ip}')
+        else:
+            b = self.read(params[1], modes[1])
+            if OPAQUE in (a, b):
+                value = OPAQUE
+            elif opcode == ADD:
+                value = a + b
+            elif opcode == MULTIPLY:
+                if isinstance(a, Linear) and isinstance(b, Linear):
+                    b = self.concrete(b, f'Product at {ip}')
+                value = a * b
+            elif opcode == LESS_THAN:
+                diff = self.concrete(a - b, f'Comparison at {ip}', 'negative')
+                value = 1 if diff < 0 else 0
+            else:
+                diff = self.concrete(a - b, f'Comparison at {ip}', 'nonzero')
+                value = 1 if diff == 0 else 0
+            self.write(params[2], modes[2], value)
+        self.instruction_ptr = next_ip
+
+    def run(self):
+        """Run to halt. Returns the outputs."""
+        while not self.is_halted:
+            self.step()
+        return self.outputs
+
+
+class AsyncIntCode:
+    """Runs an IntCode machine as an asyncio task.
+
+    The machine runs in batches of up to batch_size instructions between
+    awaits. It suspends when it needs input and resumes as soon as anything
+    is pushed onto its input channel, whether through write() or directly
+    (as day23's NIC.receive_packet does).
+    """
+
+    def __init__(self, machine, batch_size=100_000):
+        self.machine = machine
+        self.batch_size = batch_size
+        self.has_input = asyncio.Event()
+        self.has_output = asyncio.Event()
+        self.has_room = asyncio.Event()
+        machine.inputs.listener = self.has_input.set
+        self.task = None
+
+    def start(self):
+        """Start running the machine in the background. Returns the task."""
+        if not self.task:
+            self.task = asyncio.get_running_loop().create_task(self.run())
+        return self.task
+
+    async def run(self):
+        """Run the machine to halt. Returns its outputs channel."""
+        machine = self.machine
+        steps = 0  # since the last await
+        while True:
+            status = machine.run_until_blocked(self.batch_size - steps)
+            steps += machine.last_run_steps
+            if status == HAS_OUTPUT:
+                self.has_output.set()
+            elif status == OUTPUT_FULL:
+                self.has_room.clear()
+                await self.has_room.wait()
+                steps = 0
+            elif status == NEEDS_INPUT:
+                self.has_input.clear()
+                if not machine.has_input():
+                    await self.has_input.wait()
+                    steps = 0
+            elif status == HALTED:
+                self.has_output.set()
+                return machine.outputs
+            if steps >= self.batch_size:
+                await asyncio.sleep(0)
+                steps = 0
+
+    def write(self, value):
+        self.machine.inputs.push(value)
+
+    async def read(self):
+        """The machine's next output, or None once it has halted."""
+        outputs = self.machine.outputs
+        while not outputs:
+            if self.machine.is_halted:
+                return None
+            self.start()
+            self.has_output.clear()
+            await self.has_output.wait()
+        value = outputs.pop()
+        self.has_room.set()
+        return value
+
+
+async def pipe(source, dest):
+    """Copy source's outputs into dest until source halts.
+
+    Both are AsyncIntCodes. Returns the last value copied."""
+    value = None
+    while True:
+        next_value = await source.read()
+        if next_value is None:
+            return value
+        value = next_value
+        dest.write(value)
+
+
+# Each pool worker builds this once from the program image it's sent.
+_worker_machine = None
+_worker_segment = None  # the shared memory the program image is in
+
+
+def _init_worker(program, engine):
+    """program is either the memory itself or the name and length of a
+    create_shared_image() segment."""
+    global _worker_machine, _worker_segment
+    if isinstance(program, tuple):
+        name, length = program
+        _worker_segment = shared_memory.SharedMemory(name)
+        program = shared_image(_worker_segment, length)
+        util.Finalize(None, _close_worker_segment, exitpriority=0)
+    _worker_machine = IntCode(program, engine=engine)
+
+
+def _close_worker_segment():
+    global _worker_machine
+    _worker_machine = None  # and with it, its views of the segment
+    _worker_segment.close()
+
+
+def _run_job(job):
+    index, inputs = job
+    machine = _worker_machine.fork()
+    machine.inputs = inputs
+    return index, list(machine.run())
+
+
+def run_jobs(
+    program, input_vectors, processes=None, chunksize=16, until=None,
+    ordered=True, engine=None
+):
+    """Run program to halt once per input vector on a process pool.
+
+    The program image is put in one shared memory segment which every
+    worker maps; jobs only carry their inputs. Yields (index, outputs) as
+    results come back, in input order unless ordered=False. If
+    until(outputs) is true for a result, that result is yielded and the
+    pool is shut down. Closing the generator early also shuts the pool
+    down.
+    """
+    program = list(program)
+    segment = create_shared_image(program)
+    if segment:
+        program = (segment.name, len(program))
+    try:
+        with multiprocessing.Pool(
+            processes, initializer=_init_worker, initargs=(program, engine)
+        ) as pool:
+            imap = pool.imap if ordered else pool.imap_unordered
+            for index, outputs in imap(
+                _run_job, enumerate(input_vectors), chunksize
+            ):
+                yield index, outputs
+                if until and until(outputs):
+                    return
+    finally:
+        if segment:
+            segment.close()
+            segment.unlink()
+
+
 def read_memory(inp):
     text = ''.join(line for line in inp)
     return [int(x) for x in text.split(',')]
@@ -0,0 +1,716 @@
+from array import array
+from collections import OrderedDict
+import asyncio
+import json
+import os
+import time
+
+import pytest
+
+import intcode
+
+
+QUINE = [
+    109, 1, 204, -1, 1001, 100, 1, 100, 1008, 100, 16, 101, 1006, 101, 0, 99
+]
+
+
+def read_day(n):
+    return intcode.read_memory(open(f'inputs/day{n}.txt'))
+
+
+ENGINES = (
+    intcode.ENGINE_INTERPRET, intcode.ENGINE_CACHED, intcode.ENGINE_COMPILED
+)
+
+
+def test_quine():
+    for engine in ENGINES:
+        assert intcode.IntCode(QUINE, engine=engine).run() == QUINE
+
+
+def test_large_numbers():
+    program = intcode.IntCode([104, 1125899906842624, 99], engine='cached')
+    assert program.run() == [1125899906842624]
+
+
+def test_self_modifying_code(monkeypatch):
+    # Loop three times; each pass rewrites the output instruction's operand.
+    memory = [
+        104, 0,  # 0: output immediate (operand is rewritten below)
+        1001, 1, 7, 1,  # 2: mem[1] += 7
+        1001, 20, -1, 20,  # 6: counter -= 1
+        1005, 20, 0,  # 10: loop while counter != 0
+        99,  # 13
+        0, 0, 0, 0, 0, 0, 3  # 14..20: counter at 20
+    ]
+    expected = [0, 7, 14]
+    for engine in ENGINES:
+        assert intcode.IntCode(memory, engine=engine).run() == expected
+
+    # Each rewrite compiles a new block; only the latest few are kept.
+    monkeypatch.setattr(intcode, 'BLOCK_FACTORIES_SIZE', 2)
+    monkeypatch.setattr(intcode, '_block_factories', OrderedDict())
+    program = intcode.IntCode(memory, engine=intcode.ENGINE_COMPILED)
+    assert program.run() == expected
+    assert len(intcode._block_factories) == 2
+
+
+def test_write_into_running_block():
+    # The first ADD turns the second one into "output 42; halt".
+    memory = [1101, 100, 4, 4, 1101, 42, 99, 99]
+    for engine in ENGINES:
+        assert intcode.IntCode(memory, engine=engine).run() == [42]
+
+
+def test_engines_match_interpreter():
+    memory = read_day(9)
+    for inputs in ([1], [2]):
+        expected = intcode.IntCode(memory, inputs=inputs[:]).run()
+        for engine in ENGINES[1:]:
+            program = intcode.IntCode(memory, inputs=inputs[:], engine=engine)
+            assert program.run() == expected
+
+
+PATCHED = [
+    1101, 42, 0, 5,  # 0: mem[5] = 42
+    104, 0,  # 4: output mem[5]
+    1101, 104, 0, 10,  # 6: mem[10] = 104
+    99, 7,  # 10: halt, patched into output 7
+    99,  # 12
+]
+
+
+def test_aot(tmp_path, monkeypatch):
+    monkeypatch.setattr(intcode, 'AOT_CACHE_DIR', str(tmp_path))
+    blocks, dynamic = intcode.find_blocks(intcode.PagedMemory(PATCHED))
+    assert blocks == {0: 6, 6: 11}
+    assert dynamic == {5}
+    for _ in range(2):
+        program = intcode.IntCode(PATCHED, engine=intcode.ENGINE_AOT)
+        assert program.aot.DYNAMIC == [5]
+        assert program.run() == [42, 7]
+    assert len(list(tmp_path.glob('intcode_aot_*.py'))) == 1
+
+    # Blocks compiled at run time (here, after a budget runs out mid-way
+    # through one) read the dynamic parameters live too.
+    program = intcode.IntCode(PATCHED, engine=intcode.ENGINE_AOT)
+    program.run(max_steps=1)
+    assert program.instruction_ptr == 4
+    assert program.run() == [42, 7]
+    assert 4 in program.blocks and 5 not in program.code
+
+    # Modules others could have written aren't run.
+    shared = tmp_path / 'shared'
+    shared.mkdir()
+    shared.chmod(0o777)
+    with pytest.raises(ValueError):
+        intcode.load_aot(intcode.PagedMemory([104, 1, 99]), str(shared))
+    shared.chmod(0o700)
+    intcode.load_aot(intcode.PagedMemory([104, 1, 99]), str(shared))
+    for path in shared.glob('*.py'):
+        path.chmod(0o666)
+    monkeypatch.setattr(intcode, '_aot_modules', {})
+    with pytest.raises(ValueError):
+        intcode.load_aot(intcode.PagedMemory([104, 1, 99]), str(shared))
+
+    # The immediate 3 makes 3 look like code, but 199 doesn't decode.
+    program = intcode.IntCode(
+        [1105, 1, 4, 199, 104, 3, 99], engine=intcode.ENGINE_AOT)
+    assert program.run() == [3]
+
+    day9 = intcode.IntCode(read_day(9), [1], engine=intcode.ENGINE_AOT)
+    assert day9.run() == [3280416268]
+
+
+def test_fusion():
+    count = [
+        1001, 20, 1, 20,  # 0: mem[20] += 1
+        1007, 20, 100, 21,  # 4: mem[21] = mem[20] < 100
+        1005, 21, 0,  # 8: loop while mem[21]
+        4, 20, 99,  # 11
+    ]
+    program = intcode.IntCode(count, engine=intcode.ENGINE_CACHED)
+    assert program.run() == [100]
+    assert program.fusion_report() == {
+        'store_store_jump': {'fired': 100, 'steps_saved': 200},
+    }
+
+    # Budgets count every fused instruction.
+    program = intcode.IntCode(count)
+    assert program.run_until_blocked(max_steps=10) == intcode.BUDGET_EXHAUSTED
+    assert (program.instruction_ptr, program.memory[20]) == (4, 4)
+
+    # The ADD patches the target of the jump fused with it.
+    patched = [1101, 0, 9, 6, 1105, 1, 7, 104, 1, 104, 2, 99]
+    for engine in ENGINES:
+        assert intcode.IntCode(patched, engine=engine).run() == [2]
+
+    # Looking for a fusion doesn't run on past the jump into data.
+    jump_over_data = [1105, 1, 4, 199, 4, 3, 99]
+    for engine in ENGINES:
+        assert intcode.IntCode(jump_over_data, engine=engine).run() == [199]
+    program = intcode.IntCode(jump_over_data)
+    assert program.run_until_blocked() == intcode.HAS_OUTPUT
+    assert intcode.IntCode(jump_over_data).run(max_steps=10) == [199]
+    with pytest.raises(ValueError):
+        intcode.decode_instruction(111101)
+
+    # The first ADD patches the second, so the pair stops after one.
+    patch_pair = [1101, 5, 0, 7, 1101, 1, 1, 20, 104, 9, 99]
+    for engine in ENGINES:
+        program = intcode.IntCode(patch_pair, engine=engine)
+        assert program.run_until_blocked() == intcode.HAS_OUTPUT
+        assert program.last_run_steps == 3
+        program = intcode.IntCode(patch_pair, engine=engine)
+        program.run(max_steps=2)
+        assert (program.instruction_ptr, program.last_run_steps) == (8, 2)
+        program = intcode.IntCode(patch_pair, engine=engine)
+        recording = intcode.Recording(program)
+        recording.run()
+        assert recording.count == 3
+
+
+def test_paged_memory():
+    memory = intcode.PagedMemory([1, 2, 3])
+    assert memory.resident_pages == 1
+    assert memory[2] == 3
+    assert memory[1_000_000] == 0
+    memory[1_000_000] = 0
+    assert memory.resident_pages == 1
+
+    memory[5000] = 2 ** 70
+    assert memory[5000] == 2 ** 70
+    assert memory.resident_pages == 2
+    memory[5000] = -7
+    assert memory[5000] == -7
+    assert not memory.big
+    assert list(memory.items()) == [(0, 1), (1, 2), (2, 3), (5000, -7)]
+
+
+def test_overflowing_arithmetic():
+    # mem[8] = mem[7] * mem[7]; output mem[8]
+    memory = [2, 7, 7, 8, 4, 8, 99, 2 ** 40, 0]
+    for engine in ENGINES:
+        assert intcode.IntCode(memory, engine=engine).run() == [2 ** 80]
+
+
+def test_run_until_blocked():
+    # Echo inputs back, doubled, until a zero arrives.
+    memory = [
+        3, 15,  # 0: mem[15] = input
+        1006, 15, 14,  # 2: halt on zero
+        102, 2, 15, 15,  # 5: mem[15] *= 2
+        4, 15,  # 9: output mem[15]
+        1105, 1, 0,  # 11: loop
+        99,  # 14
+        0,  # 15
+    ]
+    for engine in ENGINES:
+        program = intcode.IntCode(memory, engine=engine)
+        assert program.run_until_blocked() == intcode.NEEDS_INPUT
+        assert program.run_until_blocked() == intcode.NEEDS_INPUT
+        program.inputs = [21]
+        assert program.run_until_blocked() == intcode.HAS_OUTPUT
+        assert program.outputs == [42]
+        assert program.run_until_blocked() == intcode.NEEDS_INPUT
+        program.inputs = [5]
+        assert program.run_until_blocked(max_steps=2) == (
+            intcode.BUDGET_EXHAUSTED)
+        assert program.run_until_blocked() == intcode.HAS_OUTPUT
+        program.inputs = [0]
+        assert program.run_until_blocked() == intcode.HALTED
+        assert program.run_until_blocked() == intcode.HALTED
+        assert program.outputs == [42, 10]
+
+
+def test_bounded_output(tmp_path, monkeypatch):
+    monkeypatch.setattr(intcode, 'AOT_CACHE_DIR', str(tmp_path))
+    for engine in ENGINES + (intcode.ENGINE_AOT,):
+        program = intcode.IntCode([104, 1, 104, 2, 99], engine=engine)
+        program.outputs = intcode.Channel(capacity=1)
+        assert program.run_until_blocked() == intcode.HAS_OUTPUT
+        assert program.run_until_blocked() == intcode.OUTPUT_FULL
+        assert program.instruction_ptr == 2
+        assert program.outputs.pop() == 1
+        assert program.run_until_blocked() == intcode.HAS_OUTPUT
+        assert program.outputs.pop() == 2
+        assert program.run_until_blocked() == intcode.HALTED
+
+        # run() raises, but can carry on once there's room.
+        program = intcode.IntCode([104, 1, 104, 2, 99], engine=engine)
+        program.outputs = intcode.Channel(capacity=1)
+        with pytest.raises(ValueError):
+            program.run()
+        assert program.instruction_ptr == 2
+        assert program.outputs.pop() == 1
+        assert program.run() == [2]
+
+
+def test_channel():
+    channel = intcode.Channel([1, 2], capacity=4)
+    channel.push(3)
+    channel += [4]
+    assert channel.is_full
+    assert channel == [1, 2, 3, 4]
+    try:
+        channel.push(5)
+        assert False, 'expected a full channel to raise'
+    except ValueError:
+        pass
+    assert channel.pop() == 1
+    assert channel.drain() == [2, 3, 4]
+    assert not channel
+
+
+def test_connect_feedback_loop():
+    memory = [
+        3, 26, 1001, 26, -4, 26, 3, 27, 1002, 27, 2, 27, 1, 27, 26, 27, 4, 27,
+        1001, 28, -1, 28, 1005, 28, 6, 99, 0, 0, 5
+    ]
+    amps = [intcode.IntCode(memory, [phase]) for phase in [9, 8, 7, 6, 5]]
+    for source, dest in zip(amps, amps[1:] + amps[:1]):
+        intcode.connect(source, dest)
+    amps[0].inputs.push(0)
+    while not amps[-1].is_halted:
+        for amp in amps:
+            while amp.run_until_blocked() == intcode.HAS_OUTPUT:
+                pass
+    assert amps[-1].outputs == [139629729]
+
+
+# Pass on each input plus one until it gets to 600, then halt.
+INCREMENT = [3, 100, 1001, 100, 1, 100, 4, 100, 1007, 100, 600, 101, 1005,
+             101, 0, 99]
+
+
+def test_dataflow():
+    # A ring of 200 nodes, sending a value round it four times.
+    flow = intcode.Dataflow(batch_size=7)
+    for i in range(200):
+        flow.add_node(i, intcode.IntCode(INCREMENT))
+    for i in range(200):
+        flow.add_edge(i, (i + 1) % 200)
+    flow.nodes[0].inputs.push(0)
+    assert flow.run() == intcode.HALTED
+    assert flow.nodes[199].inputs == [799]  # sent after 199 halted
+    assert flow.counts[199, 0] == 3
+    assert flow.counts[0, 1] == 4
+
+    # Fan out to two nodes, then back in to one which adds its inputs.
+    flow = intcode.Dataflow()
+    flow.add_node('source', intcode.IntCode([3, 5, 4, 5, 99, 0], [10]))
+    flow.add_node('plus', intcode.IntCode(INCREMENT))
+    flow.add_node('times', intcode.IntCode([3, 9, 102, 2, 9, 9, 4, 9, 99, 0]))
+    flow.add_node('sum', intcode.IntCode(
+        [3, 11, 3, 12, 1, 11, 12, 11, 4, 11, 99, 0, 0]))
+    for source, dest in [('source', 'plus'), ('source', 'times'),
+                         ('plus', 'sum'), ('times', 'sum')]:
+        flow.add_edge(source, dest)
+    assert flow.run(max_steps=2) == intcode.BUDGET_EXHAUSTED
+    assert flow.run() == intcode.NEEDS_INPUT  # plus wants more
+    assert flow.nodes['sum'].outputs == [31]
+    assert set(flow.counts.values()) == {1}
+    flow.send('plus', [599])
+    assert flow.run() == intcode.HALTED
+    assert flow.counts['plus', 'sum'] == 2
+    assert flow.nodes['sum'].inputs == [600]  # sent after sum halted
+    with pytest.raises(ValueError):
+        flow.add_edge('sum', 'nowhere')
+
+
+def test_fork_and_snapshot():
+    program = intcode.IntCode(read_day(9), engine=intcode.ENGINE_COMPILED)
+    snapshot = program.snapshot()
+    child = program.fork()
+    assert child.memory.private_pages == 0
+
+    program.inputs = [1]
+    assert len(program.run()) == 1
+    child.inputs = [2]
+    assert child.run() == [80210]
+
+    program.restore(snapshot)
+    program.inputs = [2]
+    assert program.run() == [80210]
+
+    memory = intcode.PagedMemory([1, 2, 3])
+    fork = memory.fork()
+    fork[0] = 10
+    assert memory[0] == 1 and fork[0] == 10
+    assert fork.private_pages == 1 and memory.private_pages == 0
+
+
+def test_shared_image():
+    memory = read_day(9)
+    image = intcode.make_image(memory)
+    machines = [intcode.IntCode(image, [1]) for _ in range(10)]
+    assert intcode.footprint(machines) == {
+        'machines': 10,
+        'shared_bytes': 8 * len(image.cells),
+        'private_bytes': 0,
+        'private_bytes_per_machine': 0,
+    }
+    for machine in machines[:2]:
+        assert machine.run() == [3280416268]
+    footprint = intcode.footprint(machines)
+    assert footprint['shared_bytes'] == 8 * len(image.cells)
+    assert footprint['private_bytes'] == 2 * 8 * intcode.PAGE_SIZE * sum(
+        type(page) is array for page in machines[0].memory.pages.values())
+
+    segment = intcode.create_shared_image(memory)
+    try:
+        image = intcode.shared_image(segment, len(memory))
+        assert list(image) == memory
+        assert intcode.IntCode(image, [1]).run() == [3280416268]
+        del image
+    finally:
+        segment.close()
+        segment.unlink()
+
+
+def test_run_batch():
+    memory = read_day(19)
+    points = [(x, y) for y in range(15) for x in range(15)]
+    expected = [intcode.IntCode(memory, [x, y]).run() for x, y in points]
+    assert intcode.run_batch(memory, points) == expected
+
+    # Lanes which overflow 64 bits carry on as IntCode machines.
+    assert intcode.run_batch([2, 7, 7, 8, 4, 8, 99, 2 ** 40, 0], [[]]) == [
+        [2 ** 80]]
+    square = [3, 11, 2, 11, 11, 12, 4, 12, 1105, 1, 0, 0, 0]
+    batch = intcode.BatchIntCode(square, [[3, 4], [2 ** 40, 5]])
+    assert batch.run(max_steps=6) == [[9], [2 ** 80]]
+    assert batch.run() == [[9, 16], [2 ** 80, 25]]
+    assert list(batch.is_blocked) == [True, True]
+
+    # Reads past the end of memory grow it first.
+    assert intcode.run_batch([4, 100, 99], [[]]) == [[0]]
+
+    # A bad instruction or address only stops the lanes which hit it.
+    program = [3, 13, 1005, 13, 9, 104, 7, 4, -1, 104, 5, 99, 42, 0]
+    batch = intcode.BatchIntCode(program, [[0], [1]])
+    assert batch.run() == [[7], [5]]
+    assert list(batch.is_failed) == [True, False]
+    assert str(batch.errors[0]) == 'Negative address: -1'
+    batch = intcode.BatchIntCode(
+        [3, 11, 1005, 11, 9, 104, 7, 99, 0, 42, 0, 0], [[1], [0]])
+    assert batch.run() == [[], [7]]
+    assert list(batch.is_failed) == [True, False]
+    assert list(batch.is_halted) == [False, True]
+    assert str(batch.errors[0]) == 'Invalid opcode: 42'
+
+
+def test_batch_patches():
+    memory = intcode.read_memory(open('inputs/day2.txt'))
+    nouns, verbs = [12, 0, 99, 5], [2, 0, 13, 50]
+    batch = intcode.BatchIntCode(
+        memory, [[]] * len(nouns), patches={1: nouns, 2: verbs})
+    assert batch.run() == [[]] * len(nouns)
+    for i, (noun, verb) in enumerate(zip(nouns, verbs)):
+        program = intcode.IntCode(memory[:1] + [noun, verb] + memory[3:])
+        program.run()
+        assert batch.memory[i, 0] == program.memory[0]
+
+
+def test_run_jobs():
+    memory = read_day(19)
+    points = [(x, y) for y in range(8) for x in range(8)]
+    expected = [intcode.IntCode(memory, [x, y]).run() for x, y in points]
+    results = list(intcode.run_jobs(memory, points, processes=2, chunksize=4))
+    assert [i for i, _ in results] == list(range(len(points)))
+    assert [outputs for _, outputs in results] == expected
+
+    first_hit = expected.index([1])
+    results = list(intcode.run_jobs(
+        memory, points, processes=2, until=lambda outputs: outputs == [1]))
+    assert results[-1] == (first_hit, [1])
+
+
+def test_async_feedback_loop():
+    memory = [
+        3, 26, 1001, 26, -4, 26, 3, 27, 1002, 27, 2, 27, 1, 27, 26, 27, 4, 27,
+        1001, 28, -1, 28, 1005, 28, 6, 99, 0, 0, 5
+    ]
+
+    async def run_amps(phases):
+        amps = [
+            intcode.AsyncIntCode(intcode.IntCode(memory, [phase]))
+            for phase in phases
+        ]
+        amps[0].write(0)
+        for amp in amps:
+            amp.start()
+        pipes = [
+            intcode.pipe(source, dest)
+            for source, dest in zip(amps, amps[1:] + amps[:1])
+        ]
+        return (await asyncio.gather(*pipes))[-1]
+
+    assert asyncio.run(run_amps([9, 8, 7, 6, 5])) == 139629729
+
+    # A machine which only outputs still yields every batch_size steps.
+    count_up = [4, 20, 1001, 20, 1, 20, 1007, 20, 20_000, 21, 1005, 21, 0, 99]
+
+    async def run_with_ticker():
+        task = intcode.AsyncIntCode(
+            intcode.IntCode(count_up), batch_size=1000).start()
+        ticks = 0
+        while not task.done():
+            ticks += 1
+            await asyncio.sleep(0)
+        return ticks, len(task.result())
+
+    ticks, outputs = asyncio.run(run_with_ticker())
+    assert outputs == 20_000
+    assert ticks >= 70  # 80,000 instructions
+
+
+def test_profiler(tmp_path):
+    program = intcode.IntCode(QUINE, engine=intcode.ENGINE_COMPILED)
+    program.profiler = intcode.Profiler(history=4)
+    assert program.run() == QUINE
+
+    profile = program.profiler.to_json()
+    assert profile['opcodes']['OUTPUT'] == len(QUINE)
+    assert profile['opcodes']['STOP'] == 1
+    # The loop's JUMP_IF_FALSE at 12 is taken every time but the last.
+    assert profile['branches']['12'] == {
+        'taken': 15, 'not_taken': 1, 'taken_ratio': 15 / 16
+    }
+    assert [ip for ip, _, _ in program.profiler.history] == [4, 8, 12, 15]
+    program.profiler.dump(tmp_path / 'profile.json')
+
+
+def test_load_image(tmp_path):
+    path = str(tmp_path / 'day9.txt')
+    with open(path, 'w') as f:
+        f.write(open('inputs/day9.txt').read())
+
+    expected = read_day(9)
+    for _ in range(2):  # Build the cached image, then map it.
+        image = intcode.load_image(path)
+        assert isinstance(image, intcode.ProgramImage)
+        assert list(image) == expected
+        assert image[-1] == expected[-1] and image[3:6] == expected[3:6]
+        program = intcode.IntCode(image, [2])
+        assert program.memory.private_pages == 0
+        assert program.run() == [80210]
+
+    with open(path, 'w') as f:
+        f.write('104,1125899906842624,99\n')
+    assert list(intcode.load_image(path)) == [104, 1125899906842624, 99]
+
+
+def test_checkpoint(tmp_path):
+    count = [1001, 20, 1, 20, 1007, 20, 100, 21, 1005, 21, 0, 4, 20, 99]
+    paths = [str(tmp_path / f'{i}.ckpt') for i in range(3)]
+    program = intcode.IntCode(count, [7, 8])
+    program.run_until_blocked(max_steps=30)
+    assert program.checkpoint(paths[0], extra={'screen': 'x'}) == 1
+
+    program.memory[3000] = 1 << 70
+    program.run_until_blocked(max_steps=30)
+    assert program.checkpoint(paths[1], incremental=True) == 2
+    assert program.checkpoint(paths[2], incremental=True) == 0
+    assert sorted(os.listdir(tmp_path)) == ['0.ckpt', '1.ckpt', '2.ckpt']
+
+    restored = intcode.IntCode([], engine=intcode.ENGINE_COMPILED)
+    assert restored.load_checkpoint(paths[0]) == {'screen': 'x'}
+    assert restored.memory[20] == 10
+    assert restored.load_checkpoint(paths[2]) is None
+    assert restored.memory[3000] == 1 << 70
+    assert restored.instruction_ptr == program.instruction_ptr
+    assert restored.inputs == [7, 8]
+    assert restored.run() == program.run() == [100]
+
+
+RUNNING_SUM = [
+    3, 100,  # 0: mem[100] = input
+    1005, 100, 6,  # 2: carry on unless it was 0
+    99,  # 5
+    1, 100, 101, 101,  # 6: mem[101] += mem[100]
+    4, 101,  # 10: output mem[101]
+    1105, 1, 0,  # 12: loop
+]
+
+
+def test_recording(tmp_path):
+    for engine in ENGINES:
+        program = intcode.IntCode(RUNNING_SUM, [1, 2, 3, 4, 0], engine=engine)
+        recording = intcode.Recording(program, interval=4)
+        assert recording.run(max_steps=10) == [1, 3]
+        assert recording.run() == [1, 3, 6, 10]
+        assert recording.count == 22
+        assert recording.inputs == [1, 2, 3, 4, 0]
+        assert [c[0] for c in recording.checkpoints] == list(range(0, 21, 4))
+
+        recording.save(str(tmp_path))
+        loaded = intcode.Recording.load(str(tmp_path), program)
+        for count in range(recording.count + 1):
+            expected = intcode.IntCode(RUNNING_SUM, [1, 2, 3, 4, 0])
+            for _ in range(count):
+                expected.run_one_instruction()
+            for replay in (recording.seek(count), loaded.seek(count)):
+                assert replay.instruction_ptr == expected.instruction_ptr
+                assert replay.memory[101] == expected.memory[101]
+                assert replay.inputs == expected.inputs
+                assert replay.outputs == expected.outputs
+        assert recording.seek(22).run() == [1, 3, 6, 10]
+
+
+def test_run_limits():
+    for engine in ENGINES:
+        spin = intcode.IntCode([1105, 1, 0], engine=engine)
+        assert spin.run(max_steps=25) == []
+        assert spin.run_status == intcode.BUDGET_EXHAUSTED
+        assert spin.last_run_steps == 25
+        spin.run(deadline=time.monotonic() + 0.01)
+        assert spin.run_status == intcode.DEADLINE_EXCEEDED
+
+        program = intcode.IntCode(RUNNING_SUM, [1, 2, 3, 0], engine=engine)
+        while program.run(max_steps=3) != [1, 3, 6]:
+            assert program.run_status == intcode.BUDGET_EXHAUSTED
+        assert program.run(max_steps=3) == [1, 3, 6]
+        assert program.run_status == intcode.HALTED
+        assert program.last_run_steps == 2
+
+
+class Poller(intcode.IntCode):
+    idle_input = -1
+
+
+POLL_LOOP = [
+    3, 20,  # 0: mem[20] = input
+    1008, 20, -1, 21,  # 2: mem[21] = mem[20] == -1
+    1005, 21, 0,  # 6: poll again if there was no input
+    4, 20,  # 9: output mem[20]
+    1105, 1, 0,  # 11: loop
+]
+
+
+def test_prove_idle():
+    for engine in ENGINES:
+        program = Poller(POLL_LOOP, engine=engine)
+        assert program.run_until_blocked() == intcode.NEEDS_INPUT
+        assert program.prove_idle()
+        assert program.idle_loop_steps == 3
+
+        for _ in range(100):
+            program.run_one_instruction()
+        assert program.idle_polls_skipped == 100
+        assert program.instruction_ptr == 0
+
+        program.inputs.push(7)
+        for _ in range(5):
+            program.run_one_instruction()
+        assert program.outputs == [7]
+
+    # A loop which counts its polls is never idle.
+    counting = POLL_LOOP[:2] + [1001, 22, 1, 22] + [
+        1008, 20, -1, 21, 1005, 21, 0, 4, 20, 1105, 1, 0
+    ]
+    program = Poller(counting)
+    assert program.run_until_blocked() == intcode.NEEDS_INPUT
+    assert not program.prove_idle()
+
+
+# Outputs fib(input), calling a recursive subroutine with the usual
+# convention: argument at [rb+1], return address at [rb+0], result returned
+# in the argument's cell.
+FIB = [
+    109, 100,  # 0: rb = 100
+    203, 1,  # 2: [rb+1] = input
+    21101, 0, 11, 0, 1105, 1, 14,  # 4: call fib
+    204, 1,  # 11: output [rb+1]
+    99,  # 13
+    109, 3,  # 14: fib: rb += 3, so n is [rb-2]
+    21207, -2, 2, -1,  # 16: [rb-1] = n < 2
+    1205, -1, 53,  # 20: return n if n < 2
+    21201, -2, -1, 1, 21101, 0, 34, 0, 1105, 1, 14,  # 23: call fib(n - 1)
+    21201, 1, 0, -1,  # 34: [rb-1] = fib(n - 1)
+    21201, -2, -2, 1, 21101, 0, 49, 0, 1105, 1, 14,  # 38: call fib(n - 2)
+    22201, -1, 1, -2,  # 49: n = [rb-1] + fib(n - 2)
+    109, -3,  # 53: return
+    2105, 1, 0,
+]
+
+
+def test_memoizer(monkeypatch):
+    assert intcode.find_calls(intcode.PagedMemory(FIB)) == {14: {11, 34, 49}}
+
+    for engine in ENGINES:
+        program = intcode.IntCode(FIB, [15], engine=engine)
+        assert program.run() == [610]
+
+        program = intcode.IntCode(FIB, [15], engine=engine)
+        program.memo = intcode.Memoizer(intcode.find_calls(program.memory))
+        assert program.run() == [610]
+        assert program.memo.hits > 0
+
+        program = intcode.IntCode(FIB, [60], engine=engine)
+        program.memo = intcode.Memoizer(intcode.find_calls(program.memory))
+        while program.run_until_blocked(max_steps=50) != intcode.HALTED:
+            pass
+        assert program.outputs == [1548008755920]
+        assert program.memo.to_json()['rejected'] == []
+
+    # Tiny caches still give the right answer.
+    program = intcode.IntCode(FIB, [12])
+    program.memo = intcode.Memoizer(intcode.find_calls(program.memory), 2)
+    assert program.run() == [144]
+    assert len(program.memo.results) == 2
+    assert program.memo.evictions > 0
+
+    # Subroutines with I/O aren't memoized.
+    printing = FIB[:53] + [204, -2] + FIB[53:]
+    program = intcode.IntCode(printing, [3])
+    program.memo = intcode.Memoizer(intcode.find_calls(program.memory))
+    assert program.run() == [1, 0, 1, 1, 2, 2]
+    assert program.memo.rejected == {14}
+
+    # Calls deep enough down to trace are stored before the ones above
+    # them run out of steps, which gets the subroutine rejected.
+    monkeypatch.setattr(intcode, 'MEMO_TRACE_STEPS', 10)
+    program = intcode.IntCode(FIB, [12])
+    program.memo = intcode.Memoizer(intcode.find_calls(program.memory))
+    assert program.run() == [144]
+    stats = json.loads(json.dumps(program.memo.to_json()))
+    assert stats == program.memo.to_json()
+    assert (stats['subroutines'], stats['rejected']) == ([], [14])
+    assert not program.memo.results
+
+
+BRANCHY = [
+    3, 30,  # 0: mem[30] = input
+    1007, 30, 10, 31,  # 2: mem[31] = mem[30] < 10
+    1006, 31, 16,  # 6: if not, go to 16
+    1001, 30, 1, 32,  # 9: output mem[30] + 1
+    4, 32,  # 13
+    99,  # 15
+    1002, 30, 2, 32,  # 16: output 2 * mem[30]
+    4, 32,  # 20
+    99,  # 22
+]
+
+
+def test_symbolic():
+    x = intcode.Linear.symbol('x')
+    program = intcode.SymbolicIntCode(BRANCHY, inputs=[x], values={'x': 3})
+    assert program.run() == [x + 1]
+    assert program.constraints == [(x - 10, '<', 0)]
+    program = intcode.SymbolicIntCode(BRANCHY, inputs=[x], values={'x': 12})
+    assert program.run() == [2 * x]
+    assert repr(program.constraints[0][0]) == 'x - 10'
+    with pytest.raises(ValueError):
+        intcode.SymbolicIntCode(BRANCHY, inputs=[x]).run()
+
+    memory = read_day(2)
+    program = intcode.SymbolicIntCode(memory, symbols={1: 'noun', 2: 'verb'})
+    program.run()
+    assert program.constraints == []
+    for noun, verb in [(12, 2), (0, 0), (99, 57)]:
+        concrete = intcode.IntCode(memory[:1] + [noun, verb] + memory[3:])
+        concrete.run()
+        values = {'noun': noun, 'verb': verb}
+        assert program[0].evaluate(values) == concrete.memory[0]